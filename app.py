@@ -5,7 +5,7 @@
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 import contextlib
 import os
-import threading
+import secrets
 from typing import TYPE_CHECKING, Any
 
 import sentry_sdk
@@ -18,26 +18,28 @@ with contextlib.suppress(ImportError):
 from uuid import uuid4
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Response
-from slowapi import _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
+from fastapi import FastAPI, HTTPException, Request, Response
 
 from derailed import database, etc, exceptions, guilds, tracks, users
+from derailed.metrics import get_latencies
 from derailed.rate_limit import rate_limiter
+from derailed.reads import StickyWrites
 
 load_dotenv()
 app = FastAPI(openapi_url=None, redoc_url=None, docs_url=None)
-app.state.limiter = rate_limiter
+app.add_middleware(StickyWrites)
 
 # Preloaded Instance Info
 INSTANCE_NAME = os.getenv('INSTANCE_NAME', '0x1244')
-NODE_ID = hex(threading.current_thread().ident)
+# set by each worker on startup, as workers forked from a preloaded app would
+# share anything made on import
+NODE_ID = ''
+# when set, `/metrics` is served to requests with this as their Authorization
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 if os.environ.get('SENTRY_DSN'):
     sentry_sdk.init(dsn=os.environ['SENTRY_DSN'], traces_sample_rate=1.0)
 
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
 # feature modules
 modules: list[str] = []
 features: list[dict[str, Any]] = [
@@ -76,6 +78,10 @@ async def load_features() -> None:
 
 @app.on_event('startup')
 async def on_startup():
+    global NODE_ID
+    NODE_ID = uuid4().hex
+
+    database.check_token_storage()
     await database.connect()
 
     # Load base routers
@@ -95,12 +101,22 @@ async def on_startup():
     await load_features()
 
 
-@app.get('/')
-@rate_limiter.limit('1/second')
+@app.get('/', dependencies=[rate_limiter.limit('1/second')])
 async def get_instance_information(request: Request, response: Response) -> dict:
     return {'instance_id': INSTANCE_NAME, 'node_id': NODE_ID, 'features': features}
 
 
+@app.get('/metrics')
+async def get_metrics(request: Request, response: Response) -> dict:
+    # latencies are per worker, so scrapers tell workers apart by `node_id`
+    if METRICS_TOKEN is None or not secrets.compare_digest(
+        request.headers.get('Authorization', ''), METRICS_TOKEN
+    ):
+        raise HTTPException(404, 'Not Found')
+
+    return {'node_id': NODE_ID, 'latencies': get_latencies()}
+
+
 if __name__ == '__main__':
     import uvicorn
 
@@ -0,0 +1,3 @@
+"""
+Microbenchmarks for the Derailed API, run with `python -m benchmarks.<name>`
+"""
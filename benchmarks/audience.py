@@ -0,0 +1,128 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import random
+import timeit
+from types import SimpleNamespace
+
+from derailed.database.audience import VISIBLE, MemberRoles, compute_audience
+from derailed.database.models import Overwrite
+from derailed.database.overwrites import CompiledOverwrites
+from derailed.database.snapshot import GuildSnapshot
+from derailed.permissions import has_bit
+
+
+# working the audience out one member at a time, as each consumer had to
+def per_member_audience(snapshot, compiled, members) -> list[str]:
+    return [
+        member.user_id
+        for member in members
+        if snapshot.is_owner(member.user_id)
+        or has_bit(compiled.apply(snapshot.get_permissions(member), member), VISIBLE)
+    ]
+
+
+def make_guild(roles: int, members: int):
+    role_ids = [f'role{i}' for i in range(roles)]
+    snapshot = GuildSnapshot(
+        guild=SimpleNamespace(id='guild', owner_id='user0'),
+        roles=[SimpleNamespace(id='guild', permissions=VISIBLE, position=0)]
+        + [
+            SimpleNamespace(
+                id=role_id, permissions=random.getrandbits(15) & ~(1 << 9), position=i
+            )
+            for i, role_id in enumerate(role_ids, start=1)
+        ],
+    )
+    compiled = CompiledOverwrites(
+        'guild',
+        [Overwrite(object_id='guild', type=1, allow=0, deny=VISIBLE)]
+        + [
+            Overwrite(object_id=role_id, type=1, allow=VISIBLE, deny=0)
+            for role_id in role_ids[: roles // 4]
+        ]
+        + [
+            Overwrite(object_id=f'user{i}', type=0, allow=0, deny=VISIBLE)
+            for i in range(0, members, 100)
+        ],
+    )
+    members = [
+        MemberRoles(
+            user_id=f'user{i}', role_ids=random.sample(role_ids, random.randint(0, 5))
+        )
+        for i in range(members)
+    ]
+
+    return snapshot, compiled, members
+
+
+def check_audience(rounds: int = 100) -> None:
+    # the batched path must agree with the per-member one, with roleless members
+    # at the start, at the end and between members with roles
+    for _ in range(rounds):
+        snapshot, compiled, members = make_guild(
+            roles=random.randint(5, 20), members=random.randint(64, 300)
+        )
+        role_ids = list(snapshot.roles)[1:]
+
+        for position in random.sample(range(len(members)), len(members) // 3):
+            members[position].role_ids = []
+
+        members[-1].role_ids = random.sample(role_ids, min(2, len(role_ids)))
+        members += [
+            MemberRoles(user_id=f'roleless{i}', role_ids=[])
+            for i in range(random.randint(0, 3))
+        ]
+
+        assert per_member_audience(snapshot, compiled, members) == compute_audience(
+            snapshot, compiled, members
+        )
+
+    # only the last role of `x` makes the track visible
+    snapshot = GuildSnapshot(
+        guild=SimpleNamespace(id='guild', owner_id='owner'),
+        roles=[
+            SimpleNamespace(id='guild', permissions=0, position=0),
+            SimpleNamespace(id='r1', permissions=0, position=1),
+            SimpleNamespace(id='r2', permissions=VISIBLE, position=2),
+        ],
+    )
+    compiled = CompiledOverwrites('guild', [])
+    members = [MemberRoles(user_id=f'user{i}', role_ids=[]) for i in range(64)]
+    members[-2:] = [
+        MemberRoles(user_id='x', role_ids=['r1', 'r2']),
+        MemberRoles(user_id='y', role_ids=[]),
+    ]
+
+    assert compute_audience(snapshot, compiled, members) == ['x']
+
+
+def bench(func, *args, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main() -> None:
+    random.seed(0)
+    check_audience()
+
+    print(f'{"members":>8} {"per member (ms)":>16} {"batched (ms)":>13} {"speedup":>8}')
+
+    for count in (100, 1000, 10000, 50000):
+        guild = make_guild(roles=40, members=count)
+        number = max(3, 20000 // count)
+
+        assert per_member_audience(*guild) == compute_audience(*guild)
+
+        single = bench(per_member_audience, *guild, number=number)
+        batched = bench(compute_audience, *guild, number=number)
+
+        print(
+            f'{count:>8} {single * 1e3:>16.2f} {batched * 1e3:>13.2f} '
+            f'{single / batched:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import json
+import timeit
+
+import msgspec
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, Field
+
+from derailed.codec import encoder
+from derailed.database import Message, get_date
+from derailed.tracks.message import MessageAction
+
+
+# how bodies were decoded, and responses encoded, before
+class PydanticMessageAction(BaseModel):
+    content: str = Field(min_length=1, max_length=1000)
+
+
+def pydantic_decode(body: bytes) -> PydanticMessageAction:
+    return PydanticMessageAction.parse_raw(body)
+
+
+decoder = msgspec.json.Decoder(MessageAction)
+
+
+def struct_decode(body: bytes) -> MessageAction:
+    # what `read_body` does, without a request
+    model = decoder.decode(body)
+    model.check()
+    return model
+
+
+def fastapi_encode(content) -> bytes:
+    # what FastAPI and JSONResponse do with a returned dict
+    return json.dumps(
+        jsonable_encoder(content),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(',', ':'),
+    ).encode('utf-8')
+
+
+def make_messages(count: int) -> list[dict]:
+    return [
+        Message.construct(
+            id=str(1 << 40 | i),
+            author_id='1',
+            track_id='1',
+            timestamp=get_date(),
+            edited_timestamp=None,
+            mention_everyone=False,
+            type=0,
+            content='benchmark message ' * 4,
+        ).dict()
+        for i in range(count)
+    ]
+
+
+def bench(func, *args, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main() -> None:
+    body = b'{"content": "' + b'hello there ' * 20 + b'"}'
+
+    print(f'{"":>24} {"before (us)":>12} {"after (us)":>11} {"speedup":>8}')
+
+    before = bench(pydantic_decode, body, number=20000)
+    after = bench(struct_decode, body, number=20000)
+    print(
+        f'{"MessageAction body":>24} {before * 1e6:>12.2f} {after * 1e6:>11.2f} '
+        f'{before / after:>7.1f}x'
+    )
+
+    for count in (1, 50, 199):
+        messages = make_messages(count)
+
+        number = max(10, 20000 // count)
+        before = bench(fastapi_encode, messages, number=number)
+        after = bench(encoder.encode, messages, number=number)
+        print(
+            f'{f"{count} messages":>24} {before * 1e6:>12.2f} {after * 1e6:>11.2f} '
+            f'{before / after:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Compares turning raw Motor documents into message history, the way Beanie
+does (validating into `Message`, then `.dict()` for the response), against
+`hydrate` into `MessageRecord`. Also compares the memory each item of a page
+takes, not counting its field values, which both share with the document.
+"""
+import sys
+import timeit
+from typing import Any, Callable
+
+from pydantic import validate_model
+
+from derailed.codec import encoder
+from derailed.database import Message, get_date
+from derailed.database.records import MessageRecord, hydrate
+
+
+def make_documents(count: int, projected: bool = False) -> list[dict[str, Any]]:
+    # what the cursor returns, with or without `get_projection(MessageRecord)`
+    return [
+        {
+            '_id': str(1 << 40 | i),
+            **({} if projected else {'revision_id': None}),
+            'author_id': '1',
+            'track_id': '1',
+            'timestamp': get_date(),
+            'edited_timestamp': None,
+            'mention_everyone': False,
+            'pinned': False,
+            'type': 0,
+            'content': 'benchmark message ' * 4,
+        }
+        for i in range(count)
+    ]
+
+
+def parse_message(document: dict[str, Any]) -> Message:
+    # `Message.parse_obj`, minus the initialized collection it would need
+    values, fields_set, error = validate_model(Message, document)
+
+    if error is not None:
+        raise error
+
+    return Message.construct(fields_set, **values)
+
+
+def validated(documents: list[dict[str, Any]]) -> bytes:
+    return encoder.encode([parse_message(document).dict() for document in documents])
+
+
+def hydrated(documents: list[dict[str, Any]]) -> bytes:
+    # hydrate renames `_id` in place, as the cursor's documents are throwaway
+    return encoder.encode(
+        [hydrate(MessageRecord, dict(document)) for document in documents]
+    )
+
+
+def footprint(item: Any) -> int:
+    size = sys.getsizeof(item)
+
+    if isinstance(item, Message):
+        size += sys.getsizeof(item.__dict__) + sys.getsizeof(item.__fields_set__)
+
+    return size
+
+
+def bench(func, *args, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main() -> None:
+    print(
+        f'{"messages":>8} {"validated (us)":>15} {"hydrated (us)":>14} '
+        f'{"speedup":>8} {"validated (KiB)":>16} {"hydrated (KiB)":>15}'
+    )
+
+    for count in (1, 50, 199):
+        documents = make_documents(count)
+        projected = make_documents(count, projected=True)
+        number = max(10, 20000 // count)
+
+        before = bench(validated, documents, number=number)
+        after = bench(hydrated, projected, number=number)
+        before_size = sum(footprint(parse_message(item)) for item in documents)
+        after_size = sum(
+            footprint(hydrate(MessageRecord, dict(item))) for item in projected
+        )
+
+        print(
+            f'{count:>8} {before * 1e6:>15.2f} {after * 1e6:>14.2f} '
+            f'{before / after:>7.1f}x {before_size / 1024:>16.1f} '
+            f'{after_size / 1024:>15.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Compares message insert throughput with and without group commits, with as
+many concurrent inserts as there would be concurrent `create_message` requests.
+
+With a mongod at `MONGO_URI`, it uses (then drops) the `derailed_benchmark`
+database on it. Without one, inserts go to `SimulatedMessage` instead, which
+only models the round trips and connection pool a real deployment waits on.
+"""
+import asyncio
+import os
+import time
+from typing import Any
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError, NetworkTimeout
+
+from derailed.database.batching import InsertBatcher
+from derailed.database.engine import DOCUMENT_MODELS, get_date
+from derailed.database.messages import DocumentMessageStore
+from derailed.database.models import Message
+from derailed.identifier import make_snowflake
+
+# in seconds, what a command costs on top of the documents it writes
+ROUND_TRIP = 0.0005
+PER_DOCUMENT = 0.00001
+# motor's default maxPoolSize
+POOL_SIZE = 100
+
+
+class SimulatedMessage:
+    """Just enough of `Message` for `InsertBatcher`, kept in a dict."""
+
+    pool: asyncio.Semaphore
+    stored: dict[str, 'SimulatedMessage'] = {}
+    # makes every command fail, as if the primary was unreachable
+    unreachable = False
+
+    def __init__(self, id: str) -> None:
+        self.id = id
+
+    @classmethod
+    async def command(cls, count: int) -> None:
+        async with cls.pool:
+            await asyncio.sleep(ROUND_TRIP + PER_DOCUMENT * count)
+
+        if cls.unreachable:
+            raise NetworkTimeout('simulated timeout')
+
+    @classmethod
+    async def insert_many(cls, documents: list['SimulatedMessage'], ordered: bool):
+        await cls.command(len(documents))
+        errors: list[dict[str, Any]] = []
+
+        for index, document in enumerate(documents):
+            if document.id in cls.stored:
+                errors.append({'index': index, 'code': 11000, 'errmsg': 'E11000'})
+            else:
+                cls.stored[document.id] = document
+
+        if errors:
+            raise BulkWriteError(
+                {'writeErrors': errors, 'nInserted': len(documents) - len(errors)}
+            )
+
+    async def insert(self) -> None:
+        await self.command(1)
+
+        if self.id in self.stored:
+            raise DuplicateKeyError('E11000', 11000)
+
+        self.stored[self.id] = self
+
+
+class SimulatedStore:
+    def __init__(self, batch_size: int) -> None:
+        self.batcher = (
+            InsertBatcher(SimulatedMessage, max_size=batch_size, delay=0.002)
+            if batch_size > 1
+            else None
+        )
+
+    async def insert(self, message: SimulatedMessage) -> None:
+        if self.batcher is None:
+            await message.insert()
+        else:
+            await self.batcher.insert(message)
+
+
+def make_messages(count: int) -> list[Message]:
+    return [
+        Message(
+            id=make_snowflake(),
+            author_id='0',
+            track_id='benchmark',
+            timestamp=get_date(),
+            edited_timestamp=None,
+            mention_everyone=False,
+            type=0,
+            content='benchmark message ' * 4,
+        )
+        for _ in range(count)
+    ]
+
+
+def make_simulated(count: int) -> list[SimulatedMessage]:
+    return [SimulatedMessage(make_snowflake()) for _ in range(count)]
+
+
+async def check_batcher() -> None:
+    # only the duplicate fails, and only for its own caller
+    SimulatedMessage.stored = {}
+    batcher = InsertBatcher(SimulatedMessage, max_size=4, delay=0.002, fallback='fail')
+    documents = make_simulated(3)
+    SimulatedMessage.stored[documents[1].id] = documents[1]
+
+    results = await asyncio.gather(
+        *(batcher.insert(document) for document in documents), return_exceptions=True
+    )
+    assert results[0] is None and results[2] is None, results
+    assert isinstance(results[1], DuplicateKeyError), results
+
+    # a failed batch fails every caller, each with an exception of its own
+    SimulatedMessage.unreachable = True
+    results = await asyncio.gather(
+        *(batcher.insert(document) for document in make_simulated(3)),
+        return_exceptions=True,
+    )
+    SimulatedMessage.unreachable = False
+
+    assert all(isinstance(result, NetworkTimeout) for result in results), results
+    assert len({id(result) for result in results}) == len(results), results
+
+
+async def bench(store, messages: list[Any], concurrency: int) -> float:
+    queue = iter(messages)
+
+    async def request() -> None:
+        for message in queue:
+            await store.insert(message)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(concurrency)))
+
+    return len(messages) / (time.perf_counter() - started)
+
+
+async def run(make_store, make: Any, count: int) -> None:
+    print(f'{"concurrent":>10} {"batch":>6} {"inserts/second":>15} {"speedup":>8}')
+
+    for concurrency in (10, 100, 1000):
+        single = await bench(make_store(1), make(count), concurrency)
+        print(f'{concurrency:>10} {1:>6} {single:>15.0f}')
+
+        for batch_size in (16, 64, 256):
+            batched = await bench(make_store(batch_size), make(count), concurrency)
+            print(
+                f'{concurrency:>10} {batch_size:>6} {batched:>15.0f} '
+                f'{batched / single:>7.1f}x'
+            )
+
+
+async def main() -> None:
+    SimulatedMessage.pool = asyncio.Semaphore(POOL_SIZE)
+    await check_batcher()
+
+    if not os.getenv('MONGO_URI'):
+        print(
+            f'simulated, {ROUND_TRIP * 1e3:.1f}ms round trips, '
+            f'{POOL_SIZE} connections'
+        )
+        await run(SimulatedStore, make_simulated, 5000)
+        return
+
+    motor = AsyncIOMotorClient(os.getenv('MONGO_URI'))
+    database = motor.derailed_benchmark
+
+    await motor.drop_database('derailed_benchmark')
+    await init_beanie(database=database, document_models=DOCUMENT_MODELS)
+
+    await run(
+        lambda batch_size: DocumentMessageStore(batch_size=batch_size),
+        make_messages,
+        20000,
+    )
+
+    await motor.drop_database('derailed_benchmark')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
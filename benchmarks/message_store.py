@@ -0,0 +1,93 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Compares write and history read throughput of the message stores.
+
+Needs a mongod at `MONGO_URI`, and uses (then drops) the `derailed_benchmark`
+database on it.
+"""
+import asyncio
+import os
+import random
+import time
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from derailed.database.engine import DOCUMENT_MODELS, get_date
+from derailed.database.messages import BucketedMessageStore, DocumentMessageStore
+from derailed.database.models import Message
+from derailed.identifier import EPOCH
+
+MAX_SNOWFLAKE = (1 << 63) - 1
+
+
+def make_messages(track_id: str, count: int) -> list[Message]:
+    # roughly a message every 10 seconds, ending now
+    now = int(time.time() * 1000) - EPOCH
+    ids = sorted(
+        ((now - i * 10000) << 22) | random.getrandbits(22) for i in range(count)
+    )
+
+    return [
+        Message(
+            id=str(message_id),
+            author_id='0',
+            track_id=track_id,
+            timestamp=get_date(),
+            edited_timestamp=None,
+            mention_everyone=False,
+            type=0,
+            content='benchmark message ' * 4,
+        )
+        for message_id in ids
+    ]
+
+
+async def bench(store, name: str, track_id: str, count: int, pages: int) -> None:
+    messages = make_messages(track_id, count)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(store.insert(message) for message in messages))
+    written = time.perf_counter() - started
+
+    # pages at random depths, each 50 messages older than a random message
+    cursors = [int(random.choice(messages).id) for _ in range(pages)]
+
+    started = time.perf_counter()
+
+    for cursor in cursors:
+        await store.history(track_id, limit=50, after=-1, before=cursor)
+
+    read = time.perf_counter() - started
+
+    print(
+        f'{name:>9} {count / written:>14.0f} {pages / read:>13.0f} '
+        f'{read / pages * 1e3:>10.2f}'
+    )
+
+
+async def main() -> None:
+    random.seed(0)
+    motor = AsyncIOMotorClient(os.getenv('MONGO_URI'))
+    database = motor.derailed_benchmark
+
+    await motor.drop_database('derailed_benchmark')
+    await init_beanie(database=database, document_models=DOCUMENT_MODELS)
+
+    print(f'{"store":>9} {"writes/second":>14} {"pages/second":>13} {"page (ms)":>10}')
+
+    for store, name in (
+        (DocumentMessageStore(), 'document'),
+        (BucketedMessageStore(), 'bucketed'),
+    ):
+        await bench(store, name, track_id=name, count=20000, pages=500)
+
+    await motor.drop_database('derailed_benchmark')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Compares JSON and msgpack responses for message and role listings: how large
+they are, how long the API takes to encode them, and how long a client takes to
+decode them.
+"""
+import timeit
+from types import SimpleNamespace
+
+import msgspec
+
+from derailed.codec import encoder, msgpack_encoder, wants_msgpack
+from derailed.database import Role, get_date
+from derailed.database.records import MessageRecord
+
+
+def make_messages(count: int) -> list[MessageRecord]:
+    return [
+        MessageRecord(
+            id=str(1 << 40 | i),
+            author_id=str(1 << 41 | i),
+            track_id=str(1 << 42),
+            timestamp=get_date(),
+            edited_timestamp=None,
+            mention_everyone=False,
+            type=0,
+            content='benchmark message ' * 4,
+        )
+        for i in range(count)
+    ]
+
+
+def make_roles(count: int) -> list[dict]:
+    return [
+        Role.construct(
+            id=str(1 << 40 | i),
+            guild_id=str(1 << 42),
+            name=f'role {i}',
+            hoist=False,
+            permissions=(1 << 40) - 1,
+            position=i,
+        ).dict()
+        for i in range(count)
+    ]
+
+
+def check_negotiation() -> None:
+    cases = {
+        None: False,
+        '*/*': False,
+        'application/json': False,
+        'application/msgpack': True,
+        'Application/X-MsgPack': True,
+        'application/msgpack, application/json': True,
+        'application/msgpack;q=0': False,
+        'application/msgpack; q=0.0, */*': False,
+        'application/msgpack;q=0.5, application/json': False,
+        'application/json;q=0.5, application/msgpack': True,
+        'application/msgpack;q=0.5, */*;q=0.1': True,
+        'application/msgpack;q=oops': False,
+    }
+
+    for accept, expected in cases.items():
+        request = SimpleNamespace(headers={} if accept is None else {'accept': accept})
+        assert wants_msgpack(request) is expected, accept
+
+
+def bench(func, *args, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main() -> None:
+    check_negotiation()
+
+    print(
+        f'{"":>14} {"json (B)":>9} {"msgpack (B)":>12} {"json encode (us)":>17} '
+        f'{"msgpack encode (us)":>20} {"json decode (us)":>17} '
+        f'{"msgpack decode (us)":>20}'
+    )
+
+    for name, content in (
+        ('50 messages', make_messages(50)),
+        ('199 messages', make_messages(199)),
+        ('250 roles', make_roles(250)),
+    ):
+        json_body = encoder.encode(content)
+        msgpack_body = msgspec.msgpack.encode(content)
+        number = 2000
+
+        print(
+            f'{name:>14} {len(json_body):>9} {len(msgpack_body):>12} '
+            f'{bench(encoder.encode, content, number=number) * 1e6:>17.2f} '
+            f'{bench(msgpack_encoder.encode, content, number=number) * 1e6:>20.2f} '
+            f'{bench(msgspec.json.decode, json_body, number=number) * 1e6:>17.2f} '
+            f'{bench(msgspec.msgpack.decode, msgpack_body, number=number) * 1e6:>20.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
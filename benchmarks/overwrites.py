@@ -0,0 +1,79 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import random
+import timeit
+from types import SimpleNamespace
+
+from derailed.database.models import Overwrite
+from derailed.database.overwrites import CompiledOverwrites
+from derailed.permissions import RolePermissionEnum, has_bit
+
+VISIBLE = RolePermissionEnum.VIEW_MESSAGE_HISTORY.value
+
+
+# the linear scan `track_has_bit` used before, kept as the baseline
+def legacy_track_has_bit(value: int, visible: int, track, member) -> bool:
+    for overwrite in track.overwrites:
+        if (
+            overwrite.object_id == member.user_id
+            or overwrite.object_id in member.role_ids
+        ):
+            if has_bit(overwrite.allow, visible):
+                return True
+            elif has_bit(overwrite.deny, visible):
+                return False
+
+    return has_bit(value, visible)
+
+
+def make_track(roles: int, members: int):
+    # nothing the member has is overwritten, so the scan can't stop early
+    overwrites = [
+        Overwrite(object_id=f'role{i}', type=1, allow=0, deny=VISIBLE)
+        for i in range(roles)
+    ] + [
+        Overwrite(object_id=f'user{i}', type=0, allow=0, deny=VISIBLE)
+        for i in range(members)
+    ]
+    random.shuffle(overwrites)
+
+    return SimpleNamespace(id='track', guild_id='guild', overwrites=overwrites)
+
+
+def bench(func, *args, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main() -> None:
+    random.seed(0)
+
+    print(
+        f'{"overwrites":>10} {"roles":>6} {"legacy (us)":>12} '
+        f'{"compiled (us)":>14} {"speedup":>8}'
+    )
+
+    for overwrites, roles in ((2, 1), (10, 5), (50, 10), (200, 20), (1000, 50)):
+        track = make_track(roles=overwrites // 2, members=overwrites // 2)
+        member = SimpleNamespace(
+            user_id='member', role_ids=[f'other{i}' for i in range(roles)]
+        )
+        compiled = CompiledOverwrites(track.guild_id, track.overwrites)
+
+        legacy = bench(
+            legacy_track_has_bit, VISIBLE, VISIBLE, track, member, number=2000
+        )
+        new = bench(
+            lambda: has_bit(compiled.apply(VISIBLE, member), VISIBLE), number=2000
+        )
+
+        print(
+            f'{overwrites:>10} {roles:>6} {legacy * 1e6:>12.2f} '
+            f'{new * 1e6:>14.2f} {legacy / new:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
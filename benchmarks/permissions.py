@@ -0,0 +1,102 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import functools
+import itertools
+import operator
+import random
+import timeit
+
+from derailed.permissions import (
+    PermissionValue,
+    RolePermissionEnum,
+    combine_role_permission_values,
+    has_bit,
+    numpy,
+    or_segments,
+)
+
+
+# the IntFlag product loop this module replaced, kept as the baseline
+def legacy_combine_role_permission_values(*permission_values: PermissionValue):
+    modified_value = 0
+    _internal = []
+
+    for value in permission_values:
+        _internal.insert(value['position'], value['value'])
+
+    for value, permission_value in itertools.product(_internal, RolePermissionEnum):
+        if has_bit(modified_value, permission_value.value) and not has_bit(
+            value, permission_value.value
+        ):
+            modified_value -= permission_value.value
+        elif not has_bit(modified_value, permission_value.value) and has_bit(
+            value, permission_value.value
+        ):
+            modified_value |= permission_value.value
+        else:
+            continue
+
+    return modified_value
+
+
+def make_roles(count: int) -> list[PermissionValue]:
+    # no ADMINISTRATOR, so neither implementation can stop early
+    return [
+        PermissionValue(position=position, value=random.getrandbits(15) & ~(1 << 9))
+        for position in range(1, count + 1)
+    ]
+
+
+def check_or_segments(rounds: int = 200) -> None:
+    # the batched fold audiences use must agree with folding each run, even for
+    # empty runs at the start, at the end and after a run of several values
+    if numpy is None:
+        return
+
+    for _ in range(rounds):
+        runs = [
+            [random.getrandbits(16) for _ in range(random.choice((0, 0, 1, 2, 5)))]
+            for _ in range(random.randint(1, 300))
+        ]
+        runs[:0] = [[]] * random.randint(0, 3)
+        runs += [[random.getrandbits(16), random.getrandbits(16)]]
+        runs += [[]] * random.randint(0, 3)
+
+        flat = numpy.array(list(itertools.chain.from_iterable(runs)), dtype=numpy.int64)
+        lengths = numpy.array([len(run) for run in runs], dtype=numpy.int64)
+        expected = [functools.reduce(operator.or_, run, 0) for run in runs]
+
+        assert or_segments(flat, lengths).tolist() == expected, runs
+
+    flat = numpy.array([1] * 62 + [2, 4], dtype=numpy.int64)
+    lengths = numpy.array([1] * 62 + [2, 0], dtype=numpy.int64)
+    assert or_segments(flat, lengths).tolist()[-2:] == [6, 0]
+
+
+def bench(func, *args, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number
+
+
+def main() -> None:
+    random.seed(0)
+    check_or_segments()
+
+    print(f'{"roles":>6} {"legacy (us)":>12} {"new (us)":>10} {"speedup":>8}')
+
+    for count in (1, 5, 20, 50, 100, 250):
+        roles = make_roles(count)
+        number = max(10, 20000 // count)
+
+        legacy = bench(legacy_combine_role_permission_values, *roles, number=number)
+        new = bench(combine_role_permission_values, *roles, number=number)
+
+        print(
+            f'{count:>6} {legacy * 1e6:>12.2f} {new * 1e6:>10.2f} {legacy / new:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Generic, TypeVar
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """A bounded, per-worker LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_size: int, ttl: float | None = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.peek(key) is not None
+
+    def _expired(self, expires_at: float) -> bool:
+        return self.ttl is not None and expires_at < monotonic()
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        item = self._data.get(key)
+
+        if item is None or self._expired(item[0]):
+            if item is not None:
+                del self._data[key]
+
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def peek(self, key: K) -> V | None:
+        # same as get, but without touching the counters or the LRU order
+        item = self._data.get(key)
+
+        if item is None or self._expired(item[0]):
+            return None
+
+        return item[1]
+
+    def set(self, key: K, value: V) -> None:
+        expires_at = monotonic() + self.ttl if self.ttl is not None else 0.0
+
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> V | None:
+        item = self._data.pop(key, None)
+        return None if item is None else item[1]
+
+    def invalidate(self, predicate: Callable[[K, V], bool]) -> int:
+        keys = [key for key, (_, value) in self._data.items() if predicate(key, value)]
+
+        for key in keys:
+            del self._data[key]
+
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,142 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+msgspec based request and response bodies, for the routes which opt into them.
+
+Such a route takes its body as `model: SomeBody = Depends(read_body(SomeBody))`,
+and returns `respond(content, request, response)`, which skips FastAPI's
+`jsonable_encoder`. Both speak msgpack instead of JSON when the client asks to,
+with `Content-Type` and `Accept` headers of `application/msgpack`.
+"""
+from typing import Any, Awaitable, Callable, Sized, Type, TypeVar
+
+import msgspec
+from fastapi import HTTPException, Request, Response
+
+B = TypeVar('B', bound='Body')
+
+MSGPACK_TYPES = frozenset(('application/msgpack', 'application/x-msgpack'))
+# what an `Accept` header can mean JSON by
+JSON_TYPES = frozenset(('application/json', 'application/*', '*/*'))
+
+encoder = msgspec.json.Encoder()
+msgpack_encoder = msgspec.msgpack.Encoder()
+
+
+class Body(msgspec.Struct):
+    """A request body. msgspec doesn't check constraints, so `check` does."""
+
+    def check(self) -> None:
+        pass
+
+
+def check_length(
+    name: str,
+    value: Sized | None,
+    min_length: int | None = None,
+    max_length: int | None = None,
+) -> None:
+    if value is None:
+        return
+
+    if min_length is not None and len(value) < min_length:
+        raise ValueError(f'`{name}` must have a length of at least {min_length}')
+
+    if max_length is not None and len(value) > max_length:
+        raise ValueError(f'`{name}` must have a length of at most {max_length}')
+
+
+def get_media_types(header: str | None) -> set[str]:
+    """The media types listed in an `Accept` or `Content-Type` header."""
+    if not header:
+        return set()
+
+    return {
+        media_type.split(';', 1)[0].strip().lower() for media_type in header.split(',')
+    }
+
+
+def get_accepted(header: str | None) -> dict[str, float]:
+    """The media types listed in an `Accept` header, and their `q` values."""
+    accepted: dict[str, float] = {}
+
+    for item in (header or '').split(','):
+        media_type, *params = item.split(';')
+        quality = 1.0
+
+        for param in params:
+            name, _, value = param.partition('=')
+
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        media_type = media_type.strip().lower()
+        accepted[media_type] = max(quality, accepted.get(media_type, 0.0))
+
+    return accepted
+
+
+def wants_msgpack(request: Request) -> bool:
+    # msgpack has to be asked for by name, and not be liked less than JSON
+    accepted = get_accepted(request.headers.get('accept'))
+    msgpack = max(accepted.get(name, 0.0) for name in MSGPACK_TYPES)
+    json = max(accepted.get(name, 0.0) for name in JSON_TYPES)
+
+    return msgpack > 0 and msgpack >= json
+
+
+def read_body(body: Type[B]) -> Callable[[Request], Awaitable[B]]:
+    json_decoder = msgspec.json.Decoder(body)
+    msgpack_decoder = msgspec.msgpack.Decoder(body)
+
+    async def decode(request: Request) -> B:
+        content_type = get_media_types(request.headers.get('content-type'))
+        decoder = (
+            json_decoder if MSGPACK_TYPES.isdisjoint(content_type) else msgpack_decoder
+        )
+
+        try:
+            model = decoder.decode(await request.body())
+            model.check()
+        except (msgspec.DecodeError, ValueError) as error:
+            raise HTTPException(422, str(error))
+
+        return model
+
+    return decode
+
+
+class FastJSONResponse(Response):
+    media_type = 'application/json'
+
+    def render(self, content: Any) -> bytes:
+        return encoder.encode(content)
+
+
+class MsgpackResponse(Response):
+    media_type = 'application/msgpack'
+
+    def render(self, content: Any) -> bytes:
+        return msgpack_encoder.encode(content)
+
+
+def respond(
+    content: Any, request: Request, response: Response, status_code: int = 200
+) -> FastJSONResponse | MsgpackResponse:
+    """
+    Encodes `content` as the client accepts, keeping what dependencies set on
+    the route's `response`.
+    """
+    cls = MsgpackResponse if wants_msgpack(request) else FastJSONResponse
+    encoded = cls(content, status_code=response.status_code or status_code)
+    encoded.headers.raw.extend(response.headers.raw)
+    # so caches between don't hand JSON to msgpack clients, or the other way around
+    encoded.headers.append('Vary', 'Accept')
+
+    return encoded
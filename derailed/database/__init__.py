@@ -1,7 +1,11 @@
 """
 Derailed's Database Configuration and Models
 """
+from .audience import *
 from .authorization import *
+from .context import *
 from .engine import *
 from .models import *
+from .overwrites import *
+from .snapshot import *
 from .utils import *
@@ -0,0 +1,216 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Cold storage for old track history.
+
+Messages are kept in immutable, zlib compressed msgpack segments, oldest first,
+and `ArchiveSegment` documents are a sparse index of which ids each one holds.
+"""
+import asyncio
+import mmap
+import os
+import zlib
+from pathlib import Path
+from typing import Any
+
+import pymongo
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from msgspec import msgpack
+
+from ..cache import TTLCache
+from .engine import get_date
+from .models import ArchiveSegment, Message
+from .records import MessageRecord, hydrate, to_dict
+
+# local or gridfs, archiving is off when this is not set
+ARCHIVE_STORE = os.getenv('ARCHIVE_STORE')
+ARCHIVE_PATH = os.getenv('ARCHIVE_PATH', '.data/archive')
+# decoded segments kept per worker, so paging through one doesn't decode it again
+ARCHIVE_CACHE_SIZE = int(os.getenv('ARCHIVE_CACHE_SIZE', 64))
+
+
+def encode_segment(messages: list[dict[str, Any]]) -> bytes:
+    return zlib.compress(msgpack.encode(messages))
+
+
+def decode_segment(data: Any) -> list[dict[str, Any]]:
+    return msgpack.decode(zlib.decompress(data))
+
+
+class LocalSegmentStore:
+    """Segments as files under `path`, decoded straight from a memory map."""
+
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+
+    def _file(self, key: str) -> Path:
+        return self.path / f'{key}.seg'
+
+    def _save(self, key: str, data: bytes) -> None:
+        file = self._file(key)
+        file.parent.mkdir(parents=True, exist_ok=True)
+
+        # written aside and renamed, so a reader never sees half a segment
+        temp = file.with_suffix('.tmp')
+        temp.write_bytes(data)
+        os.replace(temp, file)
+
+    def _load(self, key: str) -> list[dict[str, Any]]:
+        with open(self._file(key), 'rb') as file, mmap.mmap(
+            file.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped:
+            return decode_segment(mapped)
+
+    async def save(self, key: str, data: bytes) -> None:
+        await asyncio.to_thread(self._save, key, data)
+
+    async def load(self, key: str) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self._load, key)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._file(key).unlink, missing_ok=True)
+
+
+class GridFSSegmentStore:
+    """Segments as GridFS files in the `archive` bucket of the database."""
+
+    @property
+    def bucket(self) -> AsyncIOMotorGridFSBucket:
+        return AsyncIOMotorGridFSBucket(
+            ArchiveSegment.get_motor_collection().database, bucket_name='archive'
+        )
+
+    async def save(self, key: str, data: bytes) -> None:
+        # a run archived twice, after a crash, replaces its segment
+        await self.delete(key)
+        await self.bucket.upload_from_stream_with_id(key, key, data)
+
+    async def load(self, key: str) -> list[dict[str, Any]]:
+        stream = await self.bucket.open_download_stream(key)
+        return decode_segment(await stream.read())
+
+    async def delete(self, key: str) -> None:
+        try:
+            await self.bucket.delete(key)
+        except NoFile:
+            pass
+
+
+class MessageArchive:
+    def __init__(self, segments: LocalSegmentStore | GridFSSegmentStore) -> None:
+        self.segments = segments
+        self.cache: TTLCache[str, list[dict[str, Any]]] = TTLCache(
+            max_size=ARCHIVE_CACHE_SIZE
+        )
+
+    async def load(self, segment_id: str) -> list[dict[str, Any]]:
+        messages = self.cache.get(segment_id)
+
+        if messages is None:
+            messages = await self.segments.load(segment_id)
+            self.cache.set(segment_id, messages)
+
+        return messages
+
+    async def append(
+        self, track_id: str, messages: list[MessageRecord]
+    ) -> ArchiveSegment:
+        """Archives `messages`, which must be oldest first, as one segment."""
+        first_id, last_id = messages[0].id, messages[-1].id
+        segment = ArchiveSegment(
+            id=f'{track_id}/{first_id}-{last_id}',
+            track_id=track_id,
+            first_id=int(first_id),
+            last_id=int(last_id),
+            size=len(messages),
+            created_at=get_date(),
+        )
+
+        await self.segments.save(
+            segment.id,
+            encode_segment([to_dict(message) for message in messages]),
+        )
+        # indexed only once written, so readers never look for a missing segment
+        await segment.save()
+
+        return segment
+
+    async def get(self, track_id: str, message_id: str) -> Message | None:
+        # the first segment ending at or after the id is the only one which
+        # could have it
+        segment = await ArchiveSegment.find_one(
+            ArchiveSegment.track_id == track_id,
+            ArchiveSegment.last_id >= int(message_id),
+            sort=[(ArchiveSegment.last_id, pymongo.ASCENDING)],
+        )
+
+        if segment is None or segment.first_id > int(message_id):
+            return None
+
+        for message in await self.load(segment.id):
+            if message['id'] == message_id:
+                return Message.parse_obj(message)
+
+        return None
+
+    async def history(
+        self,
+        track_id: str,
+        limit: int,
+        after: int,
+        before: int,
+        oldest_first: bool = False,
+    ) -> list[MessageRecord]:
+        if limit <= 0:
+            return []
+
+        cursor = ArchiveSegment.find(
+            ArchiveSegment.track_id == track_id,
+            ArchiveSegment.last_id > after,
+            ArchiveSegment.first_id < before,
+            sort=[
+                (
+                    ArchiveSegment.last_id,
+                    pymongo.ASCENDING if oldest_first else pymongo.DESCENDING,
+                )
+            ],
+        )
+        # keyed by id, in case a run was archived twice
+        found: dict[str, dict[str, Any]] = {}
+
+        async for segment in cursor:
+            # segments of a track don't overlap, so the rest are past a full page
+            if len(found) >= limit:
+                break
+
+            for message in await self.load(segment.id):
+                if after < int(message['id']) < before:
+                    found[message['id']] = message
+
+        messages = sorted(
+            found.values(),
+            key=lambda message: int(message['id']),
+            reverse=not oldest_first,
+        )
+
+        return [hydrate(MessageRecord, message) for message in messages[:limit]]
+
+    async def delete_track(self, track_id: str) -> None:
+        async for segment in ArchiveSegment.find(ArchiveSegment.track_id == track_id):
+            await self.segments.delete(segment.id)
+            await segment.delete()
+
+        self.cache.invalidate(lambda key, _: key.startswith(f'{track_id}/'))
+
+
+def get_archive() -> MessageArchive | None:
+    if ARCHIVE_STORE == 'local':
+        return MessageArchive(LocalSegmentStore(ARCHIVE_PATH))
+    elif ARCHIVE_STORE == 'gridfs':
+        return MessageArchive(GridFSSegmentStore())
+
+    return None
@@ -0,0 +1,104 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Moves messages older than `ARCHIVE_AFTER` days from the message store into the
+archive, in segments of up to `ARCHIVE_SEGMENT_SIZE` messages.
+
+    python -m derailed.database.archiver [--forever]
+
+Needs `ARCHIVE_STORE` to be set, the same as the workers reading the archive.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from beanie import init_beanie
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from ..identifier import snowflake_bound
+from .engine import DOCUMENT_MODELS, get_database
+from .messages import TieredMessageStore, message_store
+from .migrate import MongoLock
+from .models import Track
+
+ARCHIVE_AFTER = float(os.getenv('ARCHIVE_AFTER', 90))
+ARCHIVE_SEGMENT_SIZE = int(os.getenv('ARCHIVE_SEGMENT_SIZE', 1000))
+# seconds between passes with --forever
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 86400))
+ARCHIVE_LOCK_TTL = float(os.getenv('ARCHIVE_LOCK_TTL', 3600))
+
+
+async def archive_track(store: TieredMessageStore, track_id: str, before: int) -> int:
+    archived = 0
+
+    while True:
+        messages = await store.hot.history(
+            track_id,
+            limit=ARCHIVE_SEGMENT_SIZE,
+            after=-1,
+            before=before,
+            oldest_first=True,
+        )
+
+        if not messages:
+            break
+
+        await store.archive.append(track_id, messages)
+        # only once the segment is written and indexed, and archiving the same
+        # run again after a crash here just replaces that segment.
+        await store.hot.delete_many(track_id, [message.id for message in messages])
+        archived += len(messages)
+
+        if len(messages) < ARCHIVE_SEGMENT_SIZE:
+            break
+
+    return archived
+
+
+async def archive(store: TieredMessageStore, database: AsyncIOMotorDatabase) -> int:
+    """Returns how many messages were archived."""
+    cutoff = int(time.time() * 1000) - int(ARCHIVE_AFTER * 86400 * 1000)
+    before = int(snowflake_bound(cutoff))
+    archived = 0
+
+    async with MongoLock(database, 'archive', ttl=ARCHIVE_LOCK_TTL):
+        async for track in Track.get_motor_collection().find({}, {'_id': 1}):
+            archived += await archive_track(store, track['_id'], before)
+
+    return archived
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m derailed.database.archiver')
+    parser.add_argument(
+        '--forever',
+        action='store_true',
+        help=f'archive again every ARCHIVE_INTERVAL ({ARCHIVE_INTERVAL:g}) seconds',
+    )
+    args = parser.parse_args()
+    load_dotenv()
+
+    if not isinstance(message_store, TieredMessageStore):
+        print('ARCHIVE_STORE is not set', file=sys.stderr)
+        return 1
+
+    database = get_database()
+    await init_beanie(database=database, document_models=DOCUMENT_MODELS)
+
+    while True:
+        print(f'archived {await archive(message_store, database)} messages')
+
+        if not args.forever:
+            return 0
+
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,183 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import itertools
+import os
+
+from derailed.cache import TTLCache
+from derailed.permissions import ADMINISTRATOR, RolePermissionEnum, has_bit, or_segments
+
+from .event import Event, listen
+from .models import Member, Track, primary_reads
+from .overwrites import CompiledOverwrites, get_compiled_overwrites
+from .records import MemberRoles, find_records
+from .snapshot import GuildSnapshot, get_guild_snapshot
+
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None
+
+AUDIENCE_CACHE_SIZE = int(os.getenv('AUDIENCE_CACHE_SIZE', 1000))
+AUDIENCE_TTL = float(os.getenv('AUDIENCE_TTL', 300))
+# larger audiences are left off events, to keep them well under the broker's
+# message size limit. Consumers then work recipients out themselves.
+AUDIENCE_EVENT_LIMIT = int(os.getenv('AUDIENCE_EVENT_LIMIT', 1000))
+
+VISIBLE: int = RolePermissionEnum.VIEW_MESSAGE_HISTORY.value
+
+
+# track id -> (guild id, ids of the users who can see the track)
+audiences: TTLCache[str, tuple[str, list[str]]] = TTLCache(
+    max_size=AUDIENCE_CACHE_SIZE, ttl=AUDIENCE_TTL
+)
+# guild id -> whether it has more members than AUDIENCE_EVENT_LIMIT. Only joins
+# and leaves change that, and slowly, so it is left to expire.
+large_guilds: TTLCache[str, bool] = TTLCache(
+    max_size=AUDIENCE_CACHE_SIZE, ttl=AUDIENCE_TTL
+)
+
+
+def compute_audience(
+    snapshot: GuildSnapshot,
+    compiled: CompiledOverwrites,
+    members: list[MemberRoles],
+) -> list[str]:
+    if numpy is None or len(members) < 64:
+        return [
+            member.user_id
+            for member in members
+            if snapshot.is_owner(member.user_id)
+            or has_bit(
+                compiled.apply(snapshot.get_permissions(member), member), VISIBLE
+            )
+        ]
+
+    # every role gets an index into the tables below, with a last, empty entry
+    # for roles which no longer exist.
+    index = {role_id: position for position, role_id in enumerate(snapshot.roles)}
+    missing = len(index)
+    role_overwrites = [compiled.roles.get(role_id, (0, 0)) for role_id in index]
+
+    permissions = numpy.array(
+        [role.permissions for role in snapshot.roles.values()] + [0],
+        dtype=numpy.int64,
+    )
+    allows = numpy.array(
+        [allow for allow, _ in role_overwrites] + [0], dtype=numpy.int64
+    )
+    denies = numpy.array([deny for _, deny in role_overwrites] + [0], dtype=numpy.int64)
+
+    # member role ids are flattened and looked up without a python level loop
+    role_lists = [member.role_ids for member in members]
+    lengths = numpy.fromiter(
+        map(len, role_lists), dtype=numpy.int64, count=len(members)
+    )
+    flat = numpy.fromiter(
+        map(
+            index.get,
+            itertools.chain.from_iterable(role_lists),
+            itertools.repeat(missing),
+        ),
+        dtype=numpy.int64,
+        count=int(lengths.sum()),
+    )
+    values, allow, deny = (
+        or_segments(table[flat], lengths) for table in (permissions, allows, denies)
+    )
+
+    # the everyone role shares the guild's id, and every member has it
+    values |= permissions[index.get(snapshot.guild.id, missing)]
+
+    bypass = (values & ADMINISTRATOR) != 0
+    everyone_allow, everyone_deny = compiled.everyone
+    values = (values & ~everyone_deny) | everyone_allow
+    values = (values & ~deny) | allow
+
+    user_ids = [member.user_id for member in members]
+    positions = dict(zip(user_ids, range(len(user_ids))))
+
+    if snapshot.owner_id in positions:
+        bypass[positions[snapshot.owner_id]] = True
+
+    for user_id, (member_allow, member_deny) in compiled.members.items():
+        position = positions.get(user_id)
+
+        if position is not None:
+            values[position] = (values[position] & ~member_deny) | member_allow
+
+    visible = bypass | ((values & (VISIBLE | ADMINISTRATOR)) != 0)
+
+    return [user_ids[position] for position in numpy.flatnonzero(visible)]
+
+
+async def resolve_audience(track: Track) -> list[str]:
+    if track.guild_id is None:
+        return list(track.members or ())
+
+    cached = audiences.get(track.id)
+
+    if cached is not None:
+        return cached[1]
+
+    snapshot = await get_guild_snapshot(guild_id=track.guild_id)
+
+    if snapshot is None:
+        return []
+
+    with primary_reads():
+        members = await find_records(Member, MemberRoles, {'guild_id': track.guild_id})
+    audience = compute_audience(
+        snapshot=snapshot, compiled=get_compiled_overwrites(track), members=members
+    )
+    audiences.set(track.id, (track.guild_id, audience))
+
+    return audience
+
+
+async def is_large_guild(guild_id: str) -> bool:
+    large = large_guilds.get(guild_id)
+
+    if large is None:
+        # counting stops once past the limit, on the guild_id index
+        count = await Member.get_motor_collection().count_documents(
+            {'guild_id': guild_id}, limit=AUDIENCE_EVENT_LIMIT + 1
+        )
+        large = count > AUDIENCE_EVENT_LIMIT
+        large_guilds.set(guild_id, large)
+
+    return large
+
+
+async def resolve_event_audience(track: Track) -> list[str] | None:
+    """The audience to attach to an event about `track`, if it is small enough."""
+    # an audience is never larger than its guild, so a guild within the limit
+    # always fits, and one over it isn't loaded only to be thrown away.
+    if track.guild_id is not None and await is_large_guild(track.guild_id):
+        return None
+
+    audience = await resolve_audience(track)
+
+    return audience if len(audience) <= AUDIENCE_EVENT_LIMIT else None
+
+
+@listen('track', 'TRACK_MODIFY', 'TRACK_DELETE')
+def forget_track_audience(event: Event) -> None:
+    audiences.pop(event.data.get('id') or event.data.get('track_id'))
+
+
+@listen(
+    'guild',
+    'ROLE_CREATE',
+    'ROLE_EDIT',
+    'ROLE_DELETE',
+    'GUILD_EDIT',
+    'GUILD_LEAVE',
+    'GUILD_JOIN',
+    'MEMBER_LEAVE',
+)
+def forget_guild_audiences(event: Event) -> None:
+    guild_id = event.guild_id or event.data.get('guild_id')
+    audiences.invalidate(lambda _, audience: audience[0] == guild_id)
@@ -0,0 +1,129 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Runs `explain` on every query shape the routers use and fails on collection scans.
+
+    python -m derailed.database.audit
+"""
+import asyncio
+import sys
+from typing import Any, Type
+
+from beanie import Document, init_beanie
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING
+
+from .engine import DOCUMENT_MODELS, get_database
+from .models import (
+    NUMERIC_COLLATION,
+    ArchiveSegment,
+    Invite,
+    Member,
+    Message,
+    MessageBucket,
+    Pin,
+    Relationship,
+    Role,
+    Track,
+    User,
+)
+
+# (model, filter, sort) for each query shape, with placeholder values.
+QUERY_SHAPES: list[tuple[Type[Document], dict[str, Any], list[tuple[str, int]]]] = [
+    (User, {'email': ''}, []),
+    (User, {'username': ''}, []),
+    (User, {'username': '', 'discriminator': ''}, []),
+    (Member, {'user_id': ''}, []),
+    (Member, {'guild_id': ''}, []),
+    (Member, {'user_id': '', 'guild_id': ''}, []),
+    (Role, {'guild_id': ''}, []),
+    (Role, {'guild_id': '', 'position': 0}, []),
+    (Track, {'guild_id': ''}, []),
+    (Track, {'guild_id': '', 'parent_id': ''}, []),
+    (Message, {'track_id': ''}, [('_id', DESCENDING)]),
+    (Message, {'track_id': '', '_id': {'$gt': '', '$lt': ''}}, [('_id', DESCENDING)]),
+    (Message, {'track_id': '', '_id': ''}, []),
+    (
+        MessageBucket,
+        {'track_id': '', 'bucket': {'$gte': 0, '$lte': 0}},
+        [('bucket', DESCENDING)],
+    ),
+    (
+        ArchiveSegment,
+        {'track_id': '', 'last_id': {'$gt': 0}, 'first_id': {'$lt': 0}},
+        [('last_id', DESCENDING)],
+    ),
+    (
+        ArchiveSegment,
+        {'track_id': '', 'last_id': {'$gte': 0}},
+        [('last_id', ASCENDING)],
+    ),
+    (Pin, {'origin': ''}, []),
+    (Invite, {'guild_id': ''}, []),
+    (Relationship, {'user_id': ''}, []),
+    (Relationship, {'user_id': '', 'target_id': ''}, []),
+]
+
+# models whose queries all pass a collation, which their indexes are built with
+COLLATIONS = {Message: NUMERIC_COLLATION}
+
+
+def get_stages(plan: Any) -> set[str]:
+    stages: set[str] = set()
+
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+
+        for value in plan.values():
+            stages |= get_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= get_stages(value)
+
+    return stages
+
+
+async def audit(database: AsyncIOMotorDatabase) -> list[str]:
+    """Returns a description of every query shape which scans its collection."""
+    await init_beanie(database=database, document_models=DOCUMENT_MODELS)
+    problems: list[str] = []
+
+    for model, query, sort in QUERY_SHAPES:
+        cursor = model.get_motor_collection().find(
+            query, collation=COLLATIONS.get(model)
+        )
+
+        if sort:
+            cursor = cursor.sort(sort)
+
+        explained = await cursor.explain()
+        stages = get_stages(explained['queryPlanner']['winningPlan'])
+
+        if 'COLLSCAN' in stages:
+            problems.append(f'{model.__name__} {query} sort={sort}: COLLSCAN')
+        elif sort and 'SORT' in stages:
+            problems.append(f'{model.__name__} {query} sort={sort}: in-memory SORT')
+
+    return problems
+
+
+async def main() -> int:
+    load_dotenv()
+    problems = await audit(get_database())
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+
+    indexed = len(QUERY_SHAPES) - len(problems)
+    print(f'{indexed}/{len(QUERY_SHAPES)} query shapes use indexes')
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -4,21 +4,130 @@
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 import base64
+import os
 
 import itsdangerous
 from fastapi import HTTPException
 
+from derailed.cache import TTLCache
+from derailed.exceptions import DerailedException
+from derailed.storage import MemoryStorage, storage
+
+from .event import Event, listen
 from .models import User
 
+# Session tokens are `base64(user_id).version.timestamp.signature`, signed with
+# `TOKEN_SECRET`. Legacy tokens are `base64(user_id).timestamp.signature`,
+# signed with the user's password hash, and are accepted until
+# `ALLOW_LEGACY_TOKENS` is turned off.
+TOKEN_SECRET = os.getenv('TOKEN_SECRET')
+ALLOW_LEGACY_TOKENS = os.getenv('ALLOW_LEGACY_TOKENS', 'true').lower() == 'true'
+
+session_signer = (
+    itsdangerous.TimestampSigner(TOKEN_SECRET, salt='derailed.session')
+    if TOKEN_SECRET
+    else None
+)
+
+# token -> verified user, kept per worker.
+token_cache: TTLCache[str, User] = TTLCache(
+    max_size=int(os.getenv('TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('TOKEN_CACHE_TTL', 300)),
+)
+# user id -> current token version.
+token_versions: TTLCache[str, int] = TTLCache(
+    max_size=int(os.getenv('TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('TOKEN_VERSION_TTL', 60)),
+)
+
+
+def check_token_storage() -> None:
+    # versions in one worker's memory aren't seen by the others, so its tokens
+    # would fail elsewhere and revoked ones stay valid there. `memory://` is an
+    # explicit choice of that, for running a single worker.
+    if (
+        session_signer is not None
+        and isinstance(storage, MemoryStorage)
+        and not os.getenv('STORAGE_URI', '').startswith('memory://')
+    ):
+        raise DerailedException(
+            'TOKEN_SECRET needs STORAGE_URI to share token versions between '
+            'workers, set it to memory:// to run a single worker without one'
+        )
+
+
+def _token_version_key(user_id: str) -> str:
+    return f'token_version:{user_id}'
+
+
+async def get_token_version(user_id: str) -> int:
+    version = token_versions.get(user_id)
+
+    if version is None:
+        version = int(await storage.get(_token_version_key(user_id)) or 0)
+        token_versions.set(user_id, version)
 
-def create_token(user_id: str, user_password: str) -> str:
-    signer = itsdangerous.TimestampSigner(user_password)
-    user_id = base64.b64encode(user_id.encode())
+    return version
 
-    return signer.sign(user_id).decode()
+
+async def revoke_tokens(user_id: str) -> None:
+    # every token carrying an older version stops validating
+    token_versions.set(user_id, await storage.incr(_token_version_key(user_id)))
+
+
+async def create_token(user_id: str, user_password: str) -> str:
+    encoded_user_id = base64.b64encode(user_id.encode()).decode()
+
+    if session_signer is None:
+        signer = itsdangerous.TimestampSigner(user_password)
+        return signer.sign(encoded_user_id).decode()
+
+    version = await get_token_version(user_id)
+
+    return session_signer.sign(f'{encoded_user_id}.{version}').decode()
+
+
+def unsign_session_token(token: str) -> tuple[str, int] | None:
+    if session_signer is None or token.count('.') != 3:
+        return None
+
+    try:
+        encoded_user_id, version = session_signer.unsign(token).decode().split('.')
+        return base64.b64decode(encoded_user_id.encode()).decode(), int(version)
+    except (itsdangerous.BadSignature, ValueError):
+        return None
 
 
 async def verify_token(token: str) -> User:
+    user = token_cache.get(token)
+
+    # every caller gets its own copy, so a route changing its user before
+    # failing doesn't leave those changes cached for other requests.
+    if user is not None:
+        return user.copy(deep=True)
+
+    fragmented = token.split('.')
+
+    if len(fragmented) == 4:
+        session = unsign_session_token(token)
+
+        if session is None or session[1] != await get_token_version(session[0]):
+            raise HTTPException(401, 'Unauthorized')
+
+        user = await User.find_one(User.id == session[0])
+
+        if user is None:
+            raise HTTPException(401, 'Unauthorized')
+    elif len(fragmented) == 3 and ALLOW_LEGACY_TOKENS:
+        user = await verify_legacy_token(token=token)
+    else:
+        raise HTTPException(401, 'Unauthorized')
+
+    token_cache.set(token, user.copy(deep=True))
+    return user
+
+
+async def verify_legacy_token(token: str) -> User:
     fragmented = token.split('.')
     encoded_user_id = fragmented[0]
 
@@ -36,7 +145,27 @@ async def verify_token(token: str) -> User:
 
     try:
         signer.unsign(token)
-
-        return user
     except itsdangerous.BadSignature:
         raise HTTPException(401, 'Unauthorized')
+
+    return user
+
+
+def get_verified_user_id(token: str) -> str | None:
+    # only signatures which can be checked without I/O count.
+    user = token_cache.peek(token)
+
+    if user is not None:
+        return user.id
+
+    session = unsign_session_token(token)
+    return None if session is None else session[0]
+
+
+@listen('security', 'USER_DISCONNECT')
+@listen('user', 'USER_UPDATE')
+def forget_user_tokens(event: Event) -> None:
+    token_cache.invalidate(lambda _, user: user.id == event.user_id)
+
+    if event.name == 'USER_DISCONNECT':
+        token_versions.pop(event.user_id)
@@ -0,0 +1,120 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import asyncio
+import copy
+from typing import Generic, Literal, Type, TypeVar
+
+from beanie import Document
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+
+D = TypeVar('D', bound=Document)
+
+
+class InsertBatcher(Generic[D]):
+    """
+    Group commits inserts of `model` made at about the same time.
+
+    Inserts wait up to `delay` seconds, or until `max_size` are waiting, and are
+    then written with one unordered `insert_many`. Each caller still gets its
+    own result, so one bad document only fails its own insert. If the whole
+    batch fails, `fallback` either retries each insert on its own (`single`) or
+    fails them all (`fail`).
+    """
+
+    def __init__(
+        self,
+        model: Type[D],
+        max_size: int,
+        delay: float,
+        fallback: Literal['single', 'fail'] = 'single',
+    ) -> None:
+        self.model = model
+        self.max_size = max_size
+        self.delay = delay
+        self.fallback = fallback
+        self.pending: list[tuple[D, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        # flushes in progress, so they aren't garbage collected mid-write
+        self.flushing: set[asyncio.Task] = set()
+
+    async def insert(self, document: D) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((document, future))
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.delay, self.flush)
+
+        await future
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.pending = self.pending, []
+
+        if batch:
+            task = asyncio.create_task(self.write(batch))
+            self.flushing.add(task)
+            task.add_done_callback(self.flushing.discard)
+
+    async def write(self, batch: list[tuple[D, asyncio.Future]]) -> None:
+        errors: dict[int, Exception] = {}
+
+        try:
+            await self.model.insert_many(
+                [document for document, _ in batch], ordered=False
+            )
+        except BulkWriteError as error:
+            for write_error in error.details['writeErrors']:
+                cls = DuplicateKeyError if write_error['code'] == 11000 else WriteError
+                errors[write_error['index']] = cls(
+                    write_error['errmsg'], write_error['code'], write_error
+                )
+        except Exception as error:
+            if self.fallback == 'single':
+                await asyncio.gather(
+                    *(self.write_one(document, future) for document, future in batch)
+                )
+                return
+
+            # raising one exception in many tasks would have them all write to
+            # its traceback, so each caller gets its own copy.
+            errors = {index: self.copy_error(error) for index in range(len(batch))}
+
+        for index, (_, future) in enumerate(batch):
+            # the caller may have been cancelled while it waited
+            if future.done():
+                continue
+
+            if index in errors:
+                future.set_exception(errors[index])
+            else:
+                future.set_result(None)
+
+    @staticmethod
+    def copy_error(error: Exception) -> Exception:
+        copied = copy.copy(error)
+        copied.__cause__ = error
+        return copied
+
+    async def write_one(self, document: D, future: asyncio.Future) -> None:
+        try:
+            await document.insert()
+        except DuplicateKeyError:
+            # the failed batch got as far as writing this one
+            pass
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+
+            return
+
+        if not future.done():
+            future.set_result(None)
@@ -0,0 +1,179 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import os
+from typing import Any
+
+from derailed.cache import TTLCache
+from derailed.permissions import RolePermissionEnum, has_bit
+
+from .models import Guild, Member, Role, Track, User, primary_reads
+from .overwrites import get_compiled_overwrites
+from .snapshot import GuildSnapshot, invalidations, snapshots
+
+# what every member of a group or direct message track may do
+DM_PERMISSIONS: int = (
+    RolePermissionEnum.VIEW_MESSAGE_HISTORY.value
+    | RolePermissionEnum.CREATE_MESSAGE.value
+    | RolePermissionEnum.MODIFY_TRACK.value
+)
+
+# track id -> guild id, or '' for tracks outside of guilds. A track never
+# moves between guilds, so this is never invalidated.
+track_guilds: TTLCache[str, str] = TTLCache(
+    max_size=int(os.getenv('TRACK_CONTEXT_CACHE_SIZE', 10000))
+)
+
+
+class TrackContext:
+    """A track with everything route permission checks need, loaded together."""
+
+    __slots__ = ('track', 'user', 'snapshot', 'member', 'permissions', 'is_owner')
+
+    def __init__(
+        self,
+        track: Track,
+        user: User,
+        snapshot: GuildSnapshot | None,
+        member: Member | None,
+    ) -> None:
+        self.track = track
+        self.user = user
+        self.snapshot = snapshot
+        self.member = member
+        self.is_owner = snapshot is not None and snapshot.is_owner(user.id)
+
+        if track.guild_id is None:
+            self.permissions = DM_PERMISSIONS if self.is_member else 0
+        elif member is None:
+            self.permissions = 0
+        else:
+            # the track's overwrites are already applied
+            self.permissions = get_compiled_overwrites(track).apply(
+                snapshot.get_permissions(member), member
+            )
+
+    @property
+    def is_member(self) -> bool:
+        if self.track.guild_id is None:
+            return self.user.id in (self.track.members or ())
+
+        return self.member is not None
+
+    def has(self, bit: int) -> bool:
+        return self.is_owner or has_bit(self.permissions, bit)
+
+
+def _get_context_pipeline(
+    user_id: str, with_guild: bool, with_member: bool
+) -> list[dict[str, Any]]:
+    pipeline: list[dict[str, Any]] = [{'$limit': 1}]
+
+    if with_guild:
+        pipeline.extend(
+            [
+                {
+                    '$lookup': {
+                        'from': Guild.get_motor_collection().name,
+                        'localField': 'guild_id',
+                        'foreignField': '_id',
+                        'as': '_guild',
+                    }
+                },
+                {
+                    '$lookup': {
+                        'from': Role.get_motor_collection().name,
+                        'localField': 'guild_id',
+                        'foreignField': 'guild_id',
+                        'as': '_roles',
+                    }
+                },
+            ]
+        )
+
+    if with_member:
+        pipeline.append(
+            {
+                '$lookup': {
+                    'from': Member.get_motor_collection().name,
+                    'let': {'guild_id': '$guild_id'},
+                    'pipeline': [
+                        {
+                            '$match': {
+                                'user_id': user_id,
+                                '$expr': {'$eq': ['$guild_id', '$$guild_id']},
+                            }
+                        },
+                        {'$limit': 1},
+                    ],
+                    'as': '_member',
+                }
+            }
+        )
+
+    return pipeline
+
+
+async def load_track_context(track_id: str, user: User) -> TrackContext | None:
+    # Only what the guild snapshot doesn't already have is joined in, so this
+    # is always a single round trip to Mongo.
+    stamp = invalidations.now()
+    guild_id = track_guilds.get(track_id)
+    snapshot = snapshots.get(guild_id) if guild_id else None
+    member = snapshot.members.get(user.id) if snapshot is not None else None
+
+    if guild_id == '' or member is not None:
+        track = await Track.find_one(Track.id == track_id)
+        results = {}
+    else:
+        pipeline = _get_context_pipeline(
+            user_id=user.id, with_guild=snapshot is None, with_member=True
+        )
+
+        # what this loads is cached for every request, so it never comes from a
+        # secondary which may be behind, even on routes which allow those.
+        with primary_reads():
+            documents = (
+                await Track.find(Track.id == track_id).aggregate(pipeline).to_list()
+            )
+
+        if not documents:
+            return None
+
+        results = {
+            key: documents[0].pop(key, None) for key in ('_guild', '_roles', '_member')
+        }
+        track = Track.parse_obj(documents[0])
+
+    if track is None:
+        return None
+
+    track_guilds.set(track.id, track.guild_id or '')
+
+    if track.guild_id is None:
+        return TrackContext(track=track, user=user, snapshot=None, member=None)
+
+    if snapshot is None:
+        snapshot = snapshots.peek(track.guild_id)
+
+    # nothing read is cached if the guild was invalidated while it was read
+    fresh = not invalidations.since(track.guild_id, stamp)
+
+    if snapshot is None and results.get('_guild'):
+        snapshot = GuildSnapshot(
+            guild=Guild.parse_obj(results['_guild'][0]),
+            roles=[Role.parse_obj(role) for role in results['_roles']],
+        )
+
+        if fresh:
+            snapshots.set(track.guild_id, snapshot)
+
+    if snapshot is not None and member is None and results.get('_member'):
+        member = Member.parse_obj(results['_member'][0])
+
+        if fresh:
+            snapshot.members.set(user.id, member)
+
+    return TrackContext(track=track, user=user, snapshot=snapshot, member=member)
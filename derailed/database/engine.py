@@ -3,20 +3,28 @@
 # Copyright 2022 Derailed Inc. All rights reserved.
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
+import asyncio
 import os
 from datetime import datetime, timezone
+from typing import Any
 
-from aiokafka import AIOKafkaProducer
+import msgspec
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
 from beanie import init_beanie
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 from msgspec import msgpack
+from pymongo import monitoring
 
-from .event import Event
+from derailed.metrics import observe
+
+from .event import Event, dispatch, listened_topics
 from .models import (
+    ArchiveSegment,
     Guild,
     Invite,
     Member,
     Message,
+    MessageBucket,
     Pin,
     Presence,
     Profile,
@@ -25,6 +33,15 @@ from .models import (
     Settings,
     Track,
     User,
+    get_write_tier,
+)
+
+# connections per worker, to each member of the replica set
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+# in milliseconds, idle connections are never closed when unset
+MONGO_MAX_IDLE_TIME = (
+    int(os.environ['MONGO_MAX_IDLE_TIME']) if os.getenv('MONGO_MAX_IDLE_TIME') else None
 )
 
 DOCUMENT_MODELS = [
@@ -38,22 +55,82 @@ DOCUMENT_MODELS = [
     Presence,
     Track,
     Message,
+    MessageBucket,
+    ArchiveSegment,
     Pin,
     Invite,
 ]
 
 
+WRITE_COMMANDS = {'insert', 'update', 'delete', 'findAndModify'}
+
+
+class WriteLatencyListener(monitoring.CommandListener):
+    """Records how long writes take, as `mongo_write/<tier>` latencies."""
+
+    def __init__(self) -> None:
+        self.pending: dict[tuple[Any, int], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in WRITE_COMMANDS:
+            self.pending[(event.connection_id, event.request_id)] = get_write_tier(
+                event.command.get('writeConcern')
+            )
+
+    def finished(
+        self, event: monitoring.CommandSucceededEvent | monitoring.CommandFailedEvent
+    ) -> None:
+        tier = self.pending.pop((event.connection_id, event.request_id), None)
+
+        if tier is not None:
+            observe(f'mongo_write/{tier}', event.duration_micros / 1e6)
+
+    succeeded = failed = finished
+
+
+def get_database() -> AsyncIOMotorDatabase:
+    return AsyncIOMotorClient(
+        os.getenv('MONGO_URI'),
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME,
+        # msgspec refuses to encode naive datetimes
+        tz_aware=True,
+        event_listeners=[WriteLatencyListener()],
+    ).db_name
+
+
 async def connect() -> None:
-    motor = AsyncIOMotorClient(os.getenv('MONGO_URI'))
+    # indexes are built by `python -m derailed.database.migrate` before the
+    # workers start, so they never drop any while serving traffic.
     await init_beanie(
-        database=motor.db_name,
+        database=get_database(),
         document_models=DOCUMENT_MODELS,
-        allow_index_dropping=True,
+        allow_index_dropping=False,
     )
     global producer
     producer = AIOKafkaProducer(bootstrap_servers=os.getenv('KAFKA_URI'))
     await producer.start()
 
+    if listened_topics:
+        # every worker needs every event, so this consumer has no group.
+        global consumer, consumer_task
+        consumer = AIOKafkaConsumer(
+            *listened_topics, bootstrap_servers=os.getenv('KAFKA_URI'), group_id=None
+        )
+        await consumer.start()
+        consumer_task = asyncio.create_task(consume())
+
+
+async def consume() -> None:
+    async for message in consumer:
+        try:
+            event = msgpack.decode(message.value, type=Event)
+        except msgspec.DecodeError:
+            continue
+
+        dispatch(event)
+
 
 def get_date() -> datetime:
     return datetime.now(timezone.utc)
@@ -61,3 +138,5 @@ def get_date() -> datetime:
 
 async def produce(topic: str, event: Event) -> None:
     await producer.send(topic=topic, value=msgpack.encode(event))
+    # apply the event to this worker right away, other workers get it from kafka
+    dispatch(event)
@@ -3,7 +3,8 @@
 # Copyright 2022 Derailed Inc. All rights reserved.
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
-from typing import Any
+import logging
+from typing import Any, Callable
 
 from msgspec import Struct
 
@@ -13,3 +14,37 @@ class Event(Struct):
     data: dict[str, Any]
     user_id: str | None = None
     guild_id: str | None = None
+    # ids of the users the event is meant for, when it has been worked out
+    audience: list[str] | None = None
+
+
+Listener = Callable[[Event], None]
+
+logger = logging.getLogger(__name__)
+
+# event name -> local listeners, used to keep per-worker caches in sync
+listeners: dict[str, list[Listener]] = {}
+# topics which have at least one listener and so must be consumed
+listened_topics: set[str] = set()
+
+
+def listen(topic: str, *names: str) -> Callable[[Listener], Listener]:
+    def decorator(func: Listener) -> Listener:
+        listened_topics.add(topic)
+
+        for name in names:
+            listeners.setdefault(name, []).append(func)
+
+        return func
+
+    return decorator
+
+
+def dispatch(event: Event) -> None:
+    # one failing listener must not stop the others, or end the consumer and
+    # with it every cache invalidation for the rest of the worker's life.
+    for listener in listeners.get(event.name, ()):
+        try:
+            listener(event)
+        except Exception:
+            logger.exception('%s failed to handle %s', listener.__name__, event.name)
@@ -0,0 +1,443 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Where track messages are kept, and a tool to move them between layouts.
+
+    python -m derailed.database.messages --to bucketed [--delete-source]
+
+Copying to documents can be rerun after it is interrupted, messages which were
+already copied are skipped.
+"""
+import argparse
+import asyncio
+import os
+import sys
+from typing import Any
+
+import pymongo
+from beanie import init_beanie
+from beanie.operators import In
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError
+
+from .archive import MessageArchive, get_archive
+from .batching import InsertBatcher
+from .engine import DOCUMENT_MODELS, get_database, get_date
+from .models import NUMERIC_COLLATION, Message, MessageBucket
+from .records import MessageRecord, find_records, hydrate
+
+MESSAGE_STORE = os.getenv('MESSAGE_STORE', 'document')
+# how much snowflake time one bucket spans, and how many messages it can hold
+# before another document is started for the same span.
+MESSAGE_BUCKET_SPAN = int(os.getenv('MESSAGE_BUCKET_SPAN', 3600)) * 1000
+MESSAGE_BUCKET_SIZE = int(os.getenv('MESSAGE_BUCKET_SIZE', 200))
+# message inserts are batched when this is over 1, see `InsertBatcher`. The delay
+# is in milliseconds.
+MESSAGE_BATCH_SIZE = int(os.getenv('MESSAGE_BATCH_SIZE', 1))
+MESSAGE_BATCH_DELAY = float(os.getenv('MESSAGE_BATCH_DELAY', 2)) / 1000
+MESSAGE_BATCH_FALLBACK = os.getenv('MESSAGE_BATCH_FALLBACK', 'single')
+
+
+class DocumentMessageStore:
+    """One `Message` document per message."""
+
+    def __init__(self, batch_size: int = MESSAGE_BATCH_SIZE) -> None:
+        self.batcher = (
+            InsertBatcher(
+                Message,
+                max_size=batch_size,
+                delay=MESSAGE_BATCH_DELAY,
+                fallback=MESSAGE_BATCH_FALLBACK,
+            )
+            if batch_size > 1
+            else None
+        )
+
+    async def insert(self, message: Message) -> None:
+        if self.batcher is None:
+            await message.insert()
+        else:
+            await self.batcher.insert(message)
+
+    async def get(self, track_id: str, message_id: str) -> Message | None:
+        return await Message.find_one(
+            Message.track_id == track_id, Message.id == message_id
+        )
+
+    async def edit(self, message: Message, content: str) -> None:
+        await message.set(
+            {Message.content: content, Message.edited_timestamp: get_date()}
+        )
+
+    async def delete(self, message: Message) -> None:
+        await message.delete()
+
+    async def delete_track(self, track_id: str) -> None:
+        await Message.find(Message.track_id == track_id).delete(
+            collation=NUMERIC_COLLATION
+        )
+
+    async def delete_many(self, track_id: str, message_ids: list[str]) -> None:
+        await Message.find(In(Message.id, message_ids)).delete()
+
+    async def history(
+        self,
+        track_id: str,
+        limit: int,
+        after: int,
+        before: int,
+        oldest_first: bool = False,
+    ) -> list[MessageRecord]:
+        # bounds are exclusive and compared as numbers thanks to the collation,
+        # so this is a single range scan on the (track_id, id) index.
+        if limit <= 0:
+            return []
+
+        return await find_records(
+            Message,
+            MessageRecord,
+            {'track_id': track_id, '_id': {'$gt': str(after), '$lt': str(before)}},
+            limit=limit,
+            sort=[('_id', pymongo.ASCENDING if oldest_first else pymongo.DESCENDING)],
+            collation=NUMERIC_COLLATION,
+        )
+
+
+def get_bucket(message_id: str | int) -> int:
+    return (int(message_id) >> 22) // MESSAGE_BUCKET_SPAN
+
+
+class BucketedMessageStore:
+    """Messages grouped into `MessageBucket`s by track and time."""
+
+    @property
+    def collection(self):
+        return MessageBucket.get_motor_collection()
+
+    async def insert(self, message: Message) -> None:
+        # a full bucket doesn't match, so the upsert starts another one
+        await self.collection.update_one(
+            {
+                'track_id': message.track_id,
+                'bucket': get_bucket(message.id),
+                'size': {'$lt': MESSAGE_BUCKET_SIZE},
+            },
+            {
+                '$push': {'messages': message.dict(exclude={'revision_id'})},
+                '$inc': {'size': 1},
+            },
+            upsert=True,
+        )
+
+    async def get(self, track_id: str, message_id: str) -> Message | None:
+        bucket = await self.collection.find_one(
+            {
+                'track_id': track_id,
+                'bucket': get_bucket(message_id),
+                'messages.id': message_id,
+            },
+            {'messages.$': 1},
+        )
+        return None if bucket is None else Message.parse_obj(bucket['messages'][0])
+
+    async def edit(self, message: Message, content: str) -> None:
+        message.content = content
+        message.edited_timestamp = get_date()
+
+        await self.collection.update_one(
+            {
+                'track_id': message.track_id,
+                'bucket': get_bucket(message.id),
+                'messages.id': message.id,
+            },
+            {
+                '$set': {
+                    'messages.$.content': message.content,
+                    'messages.$.edited_timestamp': message.edited_timestamp,
+                }
+            },
+        )
+
+    async def delete(self, message: Message) -> None:
+        await self.collection.update_one(
+            {
+                'track_id': message.track_id,
+                'bucket': get_bucket(message.id),
+                'messages.id': message.id,
+            },
+            {'$pull': {'messages': {'id': message.id}}, '$inc': {'size': -1}},
+        )
+
+    async def delete_track(self, track_id: str) -> None:
+        await self.collection.delete_many({'track_id': track_id})
+
+    async def delete_many(self, track_id: str, message_ids: list[str]) -> None:
+        query = {
+            'track_id': track_id,
+            'bucket': {'$in': sorted({get_bucket(id) for id in message_ids})},
+        }
+
+        await self.collection.update_many(
+            query,
+            [
+                {
+                    '$set': {
+                        'messages': {
+                            '$filter': {
+                                'input': '$messages',
+                                'cond': {'$not': [{'$in': ['$$this.id', message_ids]}]},
+                            }
+                        }
+                    }
+                },
+                {'$set': {'size': {'$size': '$messages'}}},
+            ],
+        )
+        await self.collection.delete_many({**query, 'size': 0})
+
+    async def history(
+        self,
+        track_id: str,
+        limit: int,
+        after: int,
+        before: int,
+        oldest_first: bool = False,
+    ) -> list[MessageRecord]:
+        if limit <= 0:
+            return []
+
+        cursor = self.collection.find(
+            {
+                'track_id': track_id,
+                'bucket': {
+                    '$gte': get_bucket(max(after, 0)),
+                    '$lte': get_bucket(before),
+                },
+            },
+            sort=[
+                ('bucket', pymongo.ASCENDING if oldest_first else pymongo.DESCENDING)
+            ],
+            # a page is usually within one or two buckets
+            batch_size=2,
+        )
+        found: list[dict[str, Any]] = []
+        last_bucket = None
+
+        async for bucket in cursor:
+            # a span can have several documents, so only stop between spans
+            if bucket['bucket'] != last_bucket and len(found) >= limit:
+                break
+
+            last_bucket = bucket['bucket']
+            found.extend(
+                message
+                for message in bucket['messages']
+                if after < int(message['id']) < before
+            )
+
+        found.sort(key=lambda message: int(message['id']), reverse=not oldest_first)
+
+        return [hydrate(MessageRecord, message) for message in found[:limit]]
+
+
+class TieredMessageStore:
+    """Recent messages in `hot`, and whatever the archiver has moved to `archive`."""
+
+    def __init__(
+        self,
+        hot: DocumentMessageStore | BucketedMessageStore,
+        archive: MessageArchive,
+    ) -> None:
+        self.hot = hot
+        self.archive = archive
+
+    async def insert(self, message: Message) -> None:
+        await self.hot.insert(message)
+
+    async def get(self, track_id: str, message_id: str) -> Message | None:
+        message = await self.hot.get(track_id, message_id)
+
+        if message is None:
+            message = await self.archive.get(track_id, message_id)
+
+        return message
+
+    async def ensure_hot(self, message: Message) -> None:
+        if await self.hot.get(message.track_id, message.id) is None:
+            raise HTTPException(400, 'Archived messages can not be changed')
+
+    async def edit(self, message: Message, content: str) -> None:
+        await self.ensure_hot(message)
+        await self.hot.edit(message, content)
+
+    async def delete(self, message: Message) -> None:
+        await self.ensure_hot(message)
+        await self.hot.delete(message)
+
+    async def delete_track(self, track_id: str) -> None:
+        await asyncio.gather(
+            self.hot.delete_track(track_id), self.archive.delete_track(track_id)
+        )
+
+    async def history(
+        self,
+        track_id: str,
+        limit: int,
+        after: int,
+        before: int,
+        oldest_first: bool = False,
+    ) -> list[MessageRecord]:
+        # everything archived is older than everything still hot, so a page
+        # only reaches into the other tier for whatever the first couldn't fill.
+        if oldest_first:
+            messages = await self.archive.history(
+                track_id, limit, after, before, oldest_first=True
+            )
+            after = int(messages[-1].id) if messages else after
+
+            return messages + await self.hot.history(
+                track_id, limit - len(messages), after, before, oldest_first=True
+            )
+
+        messages = await self.hot.history(track_id, limit, after, before)
+        before = int(messages[-1].id) if messages else before
+
+        return messages + await self.archive.history(
+            track_id, limit - len(messages), after, before
+        )
+
+
+def get_message_store() -> (
+    DocumentMessageStore | BucketedMessageStore | TieredMessageStore
+):
+    if MESSAGE_STORE == 'bucketed':
+        store = BucketedMessageStore()
+    else:
+        store = DocumentMessageStore()
+
+    archive = get_archive()
+
+    return store if archive is None else TieredMessageStore(store, archive)
+
+
+message_store = get_message_store()
+
+
+def make_bucket(
+    track_id: str, bucket: int, messages: list[dict[str, Any]]
+) -> dict[str, Any]:
+    return {
+        'track_id': track_id,
+        'bucket': bucket,
+        'size': len(messages),
+        'messages': messages,
+    }
+
+
+async def to_bucketed(delete_source: bool) -> int:
+    collection = MessageBucket.get_motor_collection()
+    moved = 0
+
+    for track_id in await Message.get_motor_collection().distinct('track_id'):
+        # oldest first, so only one bucket is held in memory at a time
+        pending: list[dict[str, Any]] = []
+        bucket = None
+
+        async for message in Message.find(
+            Message.track_id == track_id,
+            sort=[(Message.id, pymongo.ASCENDING)],
+            collation=NUMERIC_COLLATION,
+        ):
+            if pending and (
+                get_bucket(message.id) != bucket or len(pending) == MESSAGE_BUCKET_SIZE
+            ):
+                await collection.insert_one(make_bucket(track_id, bucket, pending))
+                moved += len(pending)
+                pending = []
+
+            bucket = get_bucket(message.id)
+            pending.append(message.dict(exclude={'revision_id'}))
+
+        if pending:
+            await collection.insert_one(make_bucket(track_id, bucket, pending))
+            moved += len(pending)
+
+        if delete_source:
+            await DocumentMessageStore().delete_track(track_id)
+
+    return moved
+
+
+async def insert_missing(documents: list[dict[str, Any]]) -> int:
+    # the documents a previous, interrupted run copied are already there, and
+    # only fail with a duplicate key. Returns how many were inserted.
+    try:
+        result = await Message.get_motor_collection().insert_many(
+            documents, ordered=False
+        )
+    except BulkWriteError as exc:
+        if any(error['code'] != 11000 for error in exc.details['writeErrors']):
+            raise
+
+        return exc.details['nInserted']
+
+    return len(result.inserted_ids)
+
+
+async def to_document(delete_source: bool) -> int:
+    collection = MessageBucket.get_motor_collection()
+    moved = 0
+
+    async for bucket in collection.find():
+        if bucket['messages']:
+            moved += await insert_missing(
+                [
+                    {
+                        '_id' if key == 'id' else key: value
+                        for key, value in message.items()
+                    }
+                    for message in bucket['messages']
+                ]
+            )
+
+        if delete_source:
+            await collection.delete_one({'_id': bucket['_id']})
+
+    return moved
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m derailed.database.messages')
+    parser.add_argument('--to', choices=('bucketed', 'document'), required=True)
+    parser.add_argument(
+        '--delete-source',
+        action='store_true',
+        help='remove messages from the old layout once they have been copied',
+    )
+    args = parser.parse_args()
+    load_dotenv()
+
+    await init_beanie(database=get_database(), document_models=DOCUMENT_MODELS)
+    # buckets have no key to tell a copied one apart from a new one, so copying
+    # to them again would duplicate messages.
+    if (
+        args.to == 'bucketed'
+        and await MessageBucket.get_motor_collection().estimated_document_count()
+    ):
+        print('MessageBucket already has documents, refusing to copy', file=sys.stderr)
+        return 1
+
+    moved = await (to_bucketed if args.to == 'bucketed' else to_document)(
+        delete_source=args.delete_source
+    )
+    print(f'moved {moved} messages')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
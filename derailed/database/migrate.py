@@ -0,0 +1,271 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Builds the indexes declared on every document and runs pending data migrations.
+
+    python -m derailed.database.migrate [--drop-indexes] [--dedupe]
+
+Only one process at a time gets past the lock, any others wait for it to finish.
+Unique indexes can't be built over duplicates, so those are reported before
+anything changes, and only removed with `--dedupe`.
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+from datetime import timedelta
+from typing import Any, Awaitable, Callable
+from uuid import uuid4
+
+from beanie import Document, init_beanie
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from .engine import DOCUMENT_MODELS, get_database, get_date
+from .models import Invite
+
+MIGRATION_LOCK_TTL = float(os.getenv('MIGRATION_LOCK_TTL', 600))
+
+logger = logging.getLogger(__name__)
+
+# how many duplicated keys are shown for each index
+DUPLICATE_REPORT_LIMIT = 20
+
+Migration = Callable[[AsyncIOMotorDatabase], Awaitable[None]]
+
+# ran in order, each once per database
+migrations: list[tuple[str, Migration]] = []
+
+
+def migration(name: str) -> Callable[[Migration], Migration]:
+    def decorator(func: Migration) -> Migration:
+        migrations.append((name, func))
+        return func
+
+    return decorator
+
+
+@migration('invite_expiry_dates')
+async def invite_expiry_dates(database: AsyncIOMotorDatabase) -> None:
+    # invites used to store their expiry as unix seconds, which TTL indexes skip
+    await Invite.get_motor_collection().update_many(
+        {'expires_at': {'$type': 'number'}},
+        [{'$set': {'expires_at': {'$toDate': {'$multiply': ['$expires_at', 1000]}}}}],
+    )
+
+
+class DuplicateKeysError(Exception):
+    """Raised when a unique index is about to be built over duplicated keys."""
+
+
+def get_new_unique_indexes(
+    model: type[Document], existing: dict[str, Any]
+) -> list[IndexModel]:
+    indexes = getattr(getattr(model, 'Settings', None), 'indexes', None) or ()
+
+    return [
+        index
+        for index in indexes
+        if isinstance(index, IndexModel)
+        and index.document.get('unique')
+        and index.document['name'] not in existing
+    ]
+
+
+async def check_duplicates(database: AsyncIOMotorDatabase, dedupe: bool) -> None:
+    """
+    Finds the keys a unique index which doesn't exist yet would be duplicated on.
+    With `dedupe`, the document with the lowest id of each is kept, which for
+    snowflakes and object ids is the oldest, and the rest are deleted.
+    """
+    report: list[str] = []
+
+    for model in DOCUMENT_MODELS:
+        settings = getattr(model, 'Settings', None)
+        collection = database[getattr(settings, 'name', None) or model.__name__]
+        existing = await collection.index_information()
+
+        for index in get_new_unique_indexes(model, existing):
+            fields = list(index.document['key'])
+            pipeline = [
+                {'$sort': {'_id': 1}},
+                {
+                    '$group': {
+                        '_id': {field: f'${field}' for field in fields},
+                        'ids': {'$push': '$_id'},
+                    }
+                },
+                {'$match': {'ids.1': {'$exists': True}}},
+            ]
+            found = 0
+
+            async for group in collection.aggregate(pipeline, allowDiskUse=True):
+                found += 1
+
+                if dedupe:
+                    await collection.delete_many({'_id': {'$in': group['ids'][1:]}})
+                elif found <= DUPLICATE_REPORT_LIMIT:
+                    report.append(
+                        f'{collection.name}.{index.document["name"]}: '
+                        f'{group["_id"]} on {group["ids"]}'
+                    )
+
+            if found and dedupe:
+                logger.warning(
+                    'Removed duplicates of %d keys from %s.%s',
+                    found,
+                    collection.name,
+                    index.document['name'],
+                )
+            elif found > DUPLICATE_REPORT_LIMIT:
+                report.append(
+                    f'{collection.name}.{index.document["name"]}: '
+                    f'and {found - DUPLICATE_REPORT_LIMIT} more keys'
+                )
+
+    if report:
+        raise DuplicateKeysError('\n'.join(report))
+
+
+class MongoLock:
+    """
+    A lock shared by every process using the database.
+
+    The lease lasts `ttl`, and is renewed while held, so it only expires if the
+    holder dies or can't reach the database.
+    """
+
+    def __init__(self, database: AsyncIOMotorDatabase, name: str, ttl: float) -> None:
+        self.collection = database['locks']
+        self.name = name
+        self.ttl = timedelta(seconds=ttl)
+        self.owner = uuid4().hex
+        self.heartbeat: asyncio.Task | None = None
+
+    async def acquire(self) -> bool:
+        now = get_date()
+        lock = {'owner': self.owner, 'expires_at': now + self.ttl}
+
+        try:
+            await self.collection.insert_one({'_id': self.name, **lock})
+            return True
+        except DuplicateKeyError:
+            pass
+
+        # take over from a holder which died without releasing it
+        taken = await self.collection.find_one_and_update(
+            {'_id': self.name, 'expires_at': {'$lt': now}}, {'$set': lock}
+        )
+        return taken is not None
+
+    async def renew(self) -> bool:
+        result = await self.collection.update_one(
+            {'_id': self.name, 'owner': self.owner},
+            {'$set': {'expires_at': get_date() + self.ttl}},
+        )
+        return result.matched_count == 1
+
+    async def renew_forever(self) -> None:
+        # a few chances to renew before the lease runs out
+        while True:
+            await asyncio.sleep(self.ttl.total_seconds() / 3)
+
+            try:
+                if not await self.renew():
+                    logger.error('Lost the %r lock to another process', self.name)
+                    return
+            except Exception:
+                logger.exception('Failed to renew the %r lock', self.name)
+
+    async def release(self) -> None:
+        await self.collection.delete_one({'_id': self.name, 'owner': self.owner})
+
+    async def __aenter__(self) -> 'MongoLock':
+        while not await self.acquire():
+            await asyncio.sleep(1)
+
+        self.heartbeat = asyncio.create_task(self.renew_forever())
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.heartbeat
+
+            self.heartbeat = None
+
+        await self.release()
+
+
+async def migrate(
+    database: AsyncIOMotorDatabase, drop_indexes: bool = False, dedupe: bool = False
+) -> list[str]:
+    """Returns the names of the migrations which were applied."""
+    applied: list[str] = []
+
+    async with MongoLock(database, 'migrate', ttl=MIGRATION_LOCK_TTL):
+        await check_duplicates(database, dedupe=dedupe)
+        await init_beanie(
+            database=database,
+            document_models=DOCUMENT_MODELS,
+            allow_index_dropping=drop_indexes,
+        )
+
+        done = {
+            document['_id']
+            async for document in database['migrations'].find({}, {'_id': 1})
+        }
+
+        for name, func in migrations:
+            if name in done:
+                continue
+
+            await func(database)
+            await database['migrations'].insert_one(
+                {'_id': name, 'applied_at': get_date()}
+            )
+            applied.append(name)
+
+    return applied
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m derailed.database.migrate')
+    parser.add_argument(
+        '--drop-indexes',
+        action='store_true',
+        help='drop indexes which are no longer declared on a document',
+    )
+    parser.add_argument(
+        '--dedupe',
+        action='store_true',
+        help='delete all but the oldest document sharing a new unique key',
+    )
+    args = parser.parse_args()
+    load_dotenv()
+
+    try:
+        applied = await migrate(
+            get_database(), drop_indexes=args.drop_indexes, dedupe=args.dedupe
+        )
+    except DuplicateKeysError as exc:
+        print(f'duplicated keys, rerun with --dedupe to remove them:\n{exc}')
+        return 1
+
+    for name in applied:
+        print(f'applied {name}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
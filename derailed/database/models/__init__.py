@@ -1,3 +1,4 @@
+from .base import *
 from .guild import *
 from .track import *
 from .user import *
@@ -0,0 +1,119 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import contextlib
+import os
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+import beanie
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.read_preferences import _ServerMode
+from pymongo.write_concern import WriteConcern
+
+
+def get_write_concern(w: str, journal: str) -> WriteConcern:
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=journal == '1')
+
+
+# `default` leaves writes with the driver's (or the URI's) write concern
+WRITE_CONCERNS: dict[str, WriteConcern | None] = {
+    'strong': get_write_concern(
+        os.getenv('WRITE_CONCERN_STRONG', 'majority'),
+        os.getenv('WRITE_JOURNAL_STRONG', '1'),
+    ),
+    'default': None,
+    'fast': get_write_concern(
+        os.getenv('WRITE_CONCERN_FAST', '1'), os.getenv('WRITE_JOURNAL_FAST', '0')
+    ),
+}
+
+# model name -> tier, anything not here is `default`. Overridden by
+# WRITE_TIERS, e.g. `Message=default,Relationship=strong`.
+WRITE_TIERS: dict[str, str] = {
+    'User': 'strong',
+    'Guild': 'strong',
+    'Member': 'strong',
+    'Role': 'strong',
+    'Track': 'strong',
+    'Invite': 'strong',
+    'Message': 'fast',
+    'MessageBucket': 'fast',
+    'Presence': 'fast',
+    'Settings': 'fast',
+}
+WRITE_TIERS.update(
+    item.strip().split('=', 1)
+    for item in os.getenv('WRITE_TIERS', '').split(',')
+    if item.strip()
+)
+
+
+def get_write_tier(write_concern: dict[str, Any] | None) -> str:
+    """The tier a command's `writeConcern` was sent for."""
+    for tier, concern in WRITE_CONCERNS.items():
+        if concern is not None and concern.document == (write_concern or {}):
+            return tier
+
+    return 'default'
+
+
+# set by routes which may read from secondaries, for the rest of their request.
+# writes always go to the primary whatever this is.
+read_preference: ContextVar[_ServerMode | None] = ContextVar(
+    'read_preference', default=None
+)
+# overrides the write tier of every model, see `writes`
+write_tier: ContextVar[str | None] = ContextVar('write_tier', default=None)
+
+_collections: dict[tuple[str, str, str], AsyncIOMotorCollection] = {}
+
+
+@contextlib.contextmanager
+def primary_reads() -> Iterator[None]:
+    """Reads from the primary inside this, for anything cached past the request."""
+    token = read_preference.set(None)
+
+    try:
+        yield
+    finally:
+        read_preference.reset(token)
+
+
+@contextlib.contextmanager
+def writes(tier: str) -> Iterator[None]:
+    """Writes every model with `tier` inside this."""
+    token = write_tier.set(tier)
+
+    try:
+        yield
+    finally:
+        write_tier.reset(token)
+
+
+class Document(beanie.Document):
+    """
+    A document which reads with the current request's read preference, and
+    writes with the write concern of its tier.
+    """
+
+    @classmethod
+    def get_motor_collection(cls) -> AsyncIOMotorCollection:
+        collection = super().get_motor_collection()
+        preference = read_preference.get()
+        tier = write_tier.get() or WRITE_TIERS.get(cls.__name__, 'default')
+
+        if preference is None and tier == 'default':
+            return collection
+
+        key = (collection.full_name, repr(preference), tier)
+        routed = _collections.get(key)
+
+        if routed is None:
+            routed = _collections[key] = collection.with_options(
+                read_preference=preference, write_concern=WRITE_CONCERNS[tier]
+            )
+
+        return routed
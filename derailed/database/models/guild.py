@@ -5,8 +5,10 @@
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 from datetime import datetime
 
-from beanie import Document
 from pydantic import Field
+from pymongo import ASCENDING, IndexModel
+
+from .base import Document
 
 
 class Guild(Document):
@@ -27,6 +29,16 @@ class Member(Document):
     joined_at: datetime
     role_ids: list[str]
 
+    class Settings:
+        indexes = [
+            IndexModel(
+                [('user_id', ASCENDING), ('guild_id', ASCENDING)],
+                name='user_id_guild_id',
+                unique=True,
+            ),
+            IndexModel([('guild_id', ASCENDING)], name='guild_id'),
+        ]
+
 
 class Role(Document):
     id: str
@@ -36,10 +48,27 @@ class Role(Document):
     permissions: int
     position: int
 
+    class Settings:
+        indexes = [
+            IndexModel(
+                [('guild_id', ASCENDING), ('position', ASCENDING)],
+                name='guild_id_position',
+            ),
+        ]
+
 
 class Invite(Document):
     id: str
     guild_id: str
     track_id: str
     inviter_id: str
-    expires_at: int | None
+    expires_at: datetime | None
+
+    class Settings:
+        indexes = [
+            IndexModel([('guild_id', ASCENDING)], name='guild_id'),
+            # mongo deletes invites itself once they expire
+            IndexModel(
+                [('expires_at', ASCENDING)], name='expires_at', expireAfterSeconds=0
+            ),
+        ]
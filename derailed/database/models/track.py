@@ -5,10 +5,17 @@
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 
 from datetime import datetime
-from typing import Literal
+from typing import Any, Literal
 
-from beanie import Document
 from pydantic import BaseModel
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collation import Collation
+
+from .base import Document
+
+# snowflakes are stored as strings, which only sort by value with this, and
+# only queries passing it can use indexes built with it.
+NUMERIC_COLLATION = Collation('en', numericOrdering=True)
 
 
 class Overwrite(BaseModel):
@@ -32,6 +39,14 @@ class Track(Document):
     parent_id: str | None
     overwrites: list[Overwrite] | None
 
+    class Settings:
+        indexes = [
+            IndexModel(
+                [('guild_id', ASCENDING), ('parent_id', ASCENDING)],
+                name='guild_id_parent_id',
+            ),
+        ]
+
 
 class Message(Document):
     id: str
@@ -44,7 +59,65 @@ class Message(Document):
     type: int
     content: str
 
+    class Settings:
+        indexes = [
+            IndexModel(
+                [('track_id', ASCENDING), ('_id', DESCENDING)],
+                name='track_id_id_numeric',
+                collation=NUMERIC_COLLATION,
+            ),
+        ]
+
+
+class MessageBucket(Document):
+    """Messages of one track made within the same span of time."""
+
+    track_id: str
+    # snowflake time, divided by the bucket span
+    bucket: int
+    size: int
+    # `Message.dict()`s
+    messages: list[dict[str, Any]]
+
+    class Settings:
+        indexes = [
+            IndexModel(
+                [('track_id', ASCENDING), ('bucket', DESCENDING)],
+                name='track_id_bucket',
+            ),
+        ]
+
+
+class ArchiveSegment(Document):
+    """An archived run of a track's messages, found in the segment store by `id`."""
+
+    id: str
+    track_id: str
+    # inclusive, as numbers
+    first_id: int
+    last_id: int
+    size: int
+    created_at: datetime
+
+    class Settings:
+        indexes = [
+            # first_id is only there so it can be filtered on without fetching
+            IndexModel(
+                [
+                    ('track_id', ASCENDING),
+                    ('last_id', DESCENDING),
+                    ('first_id', ASCENDING),
+                ],
+                name='track_id_last_id_first_id',
+            ),
+        ]
+
 
 class Pin(Document):
     id: str
     origin: str
+
+    class Settings:
+        indexes = [
+            IndexModel([('origin', ASCENDING)], name='origin'),
+        ]
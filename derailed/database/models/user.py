@@ -6,8 +6,10 @@
 from datetime import datetime
 from typing import Literal
 
-from beanie import Document
 from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
+
+from .base import Document
 
 
 class Verification(BaseModel):
@@ -23,6 +25,16 @@ class User(Document):
     password: str
     verification: Verification = Verification()
 
+    class Settings:
+        indexes = [
+            IndexModel([('email', ASCENDING)], name='email', unique=True),
+            IndexModel(
+                [('username', ASCENDING), ('discriminator', ASCENDING)],
+                name='username_discriminator',
+                unique=True,
+            ),
+        ]
+
 
 class Profile(Document):
     id: str
@@ -41,6 +53,15 @@ class Relationship(Document):
     target_id: str
     type: int
 
+    class Settings:
+        indexes = [
+            IndexModel(
+                [('user_id', ASCENDING), ('target_id', ASCENDING)],
+                name='user_id_target_id',
+                unique=True,
+            ),
+        ]
+
 
 class Presence(Document):
     id: str
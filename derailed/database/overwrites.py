@@ -0,0 +1,88 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import os
+from typing import Iterable
+
+from derailed.cache import TTLCache
+from derailed.permissions import ADMINISTRATOR, ALL_PERMISSIONS
+
+from .event import Event, listen
+from .models import Member, Overwrite, Track
+
+TRACK_OVERWRITES_CACHE_SIZE = int(os.getenv('TRACK_OVERWRITES_CACHE_SIZE', 10000))
+TRACK_OVERWRITES_TTL = float(os.getenv('TRACK_OVERWRITES_TTL', 300))
+
+
+class CompiledOverwrites:
+    """A track's overwrites, indexed by the object they apply to.
+
+    They're applied like so: the everyone role's overwrite, then the allow
+    and deny of every role the member has folded together, then the member's
+    own overwrite. Each step denies first and allows second.
+    """
+
+    __slots__ = ('everyone', 'roles', 'members')
+
+    def __init__(self, guild_id: str | None, overwrites: Iterable[Overwrite]) -> None:
+        self.everyone: tuple[int, int] = (0, 0)
+        # object id -> (allow, deny)
+        self.roles: dict[str, tuple[int, int]] = {}
+        self.members: dict[str, tuple[int, int]] = {}
+
+        for overwrite in overwrites:
+            if overwrite.type == 0:
+                self.members[overwrite.object_id] = (overwrite.allow, overwrite.deny)
+            elif overwrite.object_id == guild_id:
+                self.everyone = (overwrite.allow, overwrite.deny)
+            else:
+                self.roles[overwrite.object_id] = (overwrite.allow, overwrite.deny)
+
+    def apply(self, value: int, member: Member) -> int:
+        if value & ADMINISTRATOR:
+            return ALL_PERMISSIONS
+
+        allow, deny = self.everyone
+        value = (value & ~deny) | allow
+
+        if self.roles:
+            allow = deny = 0
+
+            for role_id in member.role_ids:
+                overwrite = self.roles.get(role_id)
+
+                if overwrite is not None:
+                    allow |= overwrite[0]
+                    deny |= overwrite[1]
+
+            value = (value & ~deny) | allow
+
+        overwrite = self.members.get(member.user_id)
+
+        if overwrite is not None:
+            value = (value & ~overwrite[1]) | overwrite[0]
+
+        return value
+
+
+# track id -> compiled overwrites, kept per worker.
+compiled_overwrites: TTLCache[str, CompiledOverwrites] = TTLCache(
+    max_size=TRACK_OVERWRITES_CACHE_SIZE, ttl=TRACK_OVERWRITES_TTL
+)
+
+
+def get_compiled_overwrites(track: Track) -> CompiledOverwrites:
+    compiled = compiled_overwrites.get(track.id)
+
+    if compiled is None:
+        compiled = CompiledOverwrites(track.guild_id, track.overwrites or ())
+        compiled_overwrites.set(track.id, compiled)
+
+    return compiled
+
+
+@listen('track', 'TRACK_MODIFY', 'TRACK_DELETE')
+def forget_compiled_overwrites(event: Event) -> None:
+    compiled_overwrites.pop(event.data.get('id') or event.data.get('track_id'))
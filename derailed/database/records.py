@@ -0,0 +1,68 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+"""
+Read only records, built straight from Motor documents without validation.
+
+Only for data the API wrote itself and reads back, for list endpoints and
+internal lookups. Anything which is written back goes through the models.
+"""
+from datetime import datetime
+from typing import Any, Type, TypeVar
+
+import msgspec
+from beanie import Document
+
+R = TypeVar('R', bound=msgspec.Struct)
+
+
+class MessageRecord(msgspec.Struct):
+    id: str
+    author_id: str
+    track_id: str
+    timestamp: datetime
+    edited_timestamp: datetime | None
+    mention_everyone: bool
+    type: int
+    content: str
+    pinned: bool = False
+
+
+class MemberRoles(msgspec.Struct):
+    user_id: str
+    role_ids: list[str]
+
+
+def get_projection(record: Type[msgspec.Struct]) -> dict[str, int]:
+    fields = record.__struct_fields__
+    projection = {field: 1 for field in fields if field != 'id'}
+    # `_id` is returned unless excluded
+    projection['_id'] = int('id' in fields)
+
+    return projection
+
+
+def hydrate(record: Type[R], document: dict[str, Any]) -> R:
+    """Builds `record` from a raw document, trusting its fields to be right."""
+    if '_id' in document:
+        document['id'] = document.pop('_id')
+
+    return record(**document)
+
+
+def to_dict(record: msgspec.Struct) -> dict[str, Any]:
+    return {field: getattr(record, field) for field in record.__struct_fields__}
+
+
+async def find_records(
+    model: Type[Document],
+    record: Type[R],
+    query: dict[str, Any],
+    **kwargs: Any,
+) -> list[R]:
+    """Like `model.find(query)`, with only the fields of `record` and no validation."""
+    cursor = model.get_motor_collection().find(query, get_projection(record), **kwargs)
+
+    return [hydrate(record, document) async for document in cursor]
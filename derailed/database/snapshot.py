@@ -0,0 +1,179 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import asyncio
+import os
+from collections import OrderedDict
+from time import monotonic
+
+from derailed.cache import TTLCache
+from derailed.permissions import combine_permissions
+
+from .event import Event, listen
+from .models import Guild, Member, Role, primary_reads
+
+GUILD_SNAPSHOT_CACHE_SIZE = int(os.getenv('GUILD_SNAPSHOT_CACHE_SIZE', 1000))
+GUILD_SNAPSHOT_MEMBERS = int(os.getenv('GUILD_SNAPSHOT_MEMBERS', 500))
+GUILD_SNAPSHOT_TTL = float(os.getenv('GUILD_SNAPSHOT_TTL', 300))
+
+
+class GuildSnapshot:
+    """What permission checks need to know about a guild, kept per worker."""
+
+    __slots__ = ('guild', 'roles', 'members')
+
+    def __init__(self, guild: Guild, roles: list[Role]) -> None:
+        self.guild = guild
+        self.roles: dict[str, Role] = {role.id: role for role in roles}
+        # user id -> member, only for members which have been looked up
+        self.members: TTLCache[str, Member] = TTLCache(max_size=GUILD_SNAPSHOT_MEMBERS)
+
+    @property
+    def owner_id(self) -> str:
+        return self.guild.owner_id
+
+    def is_owner(self, user_id: str) -> bool:
+        return self.guild.owner_id == user_id
+
+    def get_member_roles(self, member: Member) -> list[Role]:
+        # the everyone role shares the guild's id
+        roles = [
+            self.roles[role_id] for role_id in member.role_ids if role_id in self.roles
+        ]
+
+        if self.guild.id not in member.role_ids and self.guild.id in self.roles:
+            roles.append(self.roles[self.guild.id])
+
+        return roles
+
+    def get_permissions(self, member: Member) -> int:
+        return combine_permissions(
+            role.permissions for role in self.get_member_roles(member)
+        )
+
+    def get_highest_position(self, member: Member) -> int:
+        return max((role.position for role in self.get_member_roles(member)), default=0)
+
+    def get_highest_role(self) -> Role | None:
+        return max(self.roles.values(), key=lambda role: role.position, default=None)
+
+
+snapshots: TTLCache[str, GuildSnapshot] = TTLCache(
+    max_size=GUILD_SNAPSHOT_CACHE_SIZE, ttl=GUILD_SNAPSHOT_TTL
+)
+
+
+class Invalidations:
+    """
+    When each guild's snapshot was last invalidated.
+
+    A load takes `now()` before it reads, and only caches what it read if the
+    guild hasn't been invalidated `since` then. Otherwise an event arriving
+    mid-load would be undone by the load caching what the event replaced.
+
+    Invalidations older than `keep` seconds are forgotten, as no load takes
+    that long. A forgotten guild counts as invalidated when the newest forgotten
+    entry was, so a load which somehow did is still never cached.
+    """
+
+    def __init__(self, keep: float = GUILD_SNAPSHOT_TTL) -> None:
+        self.keep = keep
+        self.clock = 0
+        # the clock at the newest invalidation which was forgotten
+        self.forgotten = 0
+        # guild id -> (clock, monotonic time) at its last invalidation, oldest
+        # first
+        self.guilds: OrderedDict[str, tuple[int, float]] = OrderedDict()
+
+    def now(self) -> int:
+        return self.clock
+
+    def bump(self, guild_id: str) -> None:
+        self.clock += 1
+        now = monotonic()
+        self.guilds[guild_id] = (self.clock, now)
+        self.guilds.move_to_end(guild_id)
+
+        while self.guilds:
+            oldest, (clock, bumped_at) = next(iter(self.guilds.items()))
+
+            if bumped_at > now - self.keep:
+                break
+
+            del self.guilds[oldest]
+            self.forgotten = clock
+
+    def since(self, guild_id: str, stamp: int) -> bool:
+        entry = self.guilds.get(guild_id)
+
+        return (self.forgotten if entry is None else entry[0]) > stamp
+
+
+invalidations = Invalidations()
+
+
+async def get_guild_snapshot(guild_id: str) -> GuildSnapshot | None:
+    snapshot = snapshots.get(guild_id)
+
+    if snapshot is None:
+        stamp = invalidations.now()
+
+        # cached until an event says otherwise, so never from a lagging secondary
+        with primary_reads():
+            guild, roles = await asyncio.gather(
+                Guild.find_one(Guild.id == guild_id),
+                Role.find(Role.guild_id == guild_id).to_list(),
+            )
+
+        if guild is None:
+            return None
+
+        snapshot = GuildSnapshot(guild=guild, roles=roles)
+
+        if not invalidations.since(guild_id, stamp):
+            snapshots.set(guild_id, snapshot)
+
+    return snapshot
+
+
+async def get_member_snapshot(
+    guild_id: str, user_id: str
+) -> tuple[GuildSnapshot | None, Member | None]:
+    snapshot = await get_guild_snapshot(guild_id=guild_id)
+
+    if snapshot is None:
+        return None, None
+
+    member = snapshot.members.get(user_id)
+
+    if member is None:
+        stamp = invalidations.now()
+
+        with primary_reads():
+            member = await Member.find_one(
+                Member.user_id == user_id, Member.guild_id == guild_id
+            )
+
+        if member is not None and not invalidations.since(guild_id, stamp):
+            snapshot.members.set(user_id, member)
+
+    return snapshot, member
+
+
+@listen('guild', 'ROLE_CREATE', 'ROLE_EDIT', 'ROLE_DELETE', 'GUILD_EDIT', 'GUILD_LEAVE')
+def forget_guild_snapshot(event: Event) -> None:
+    invalidations.bump(event.guild_id)
+    snapshots.pop(event.guild_id)
+
+
+@listen('guild', 'GUILD_JOIN', 'MEMBER_LEAVE')
+def forget_member_snapshot(event: Event) -> None:
+    guild_id = event.guild_id or event.data.get('guild_id')
+    user_id = event.user_id or event.data.get('user_id')
+    invalidations.bump(guild_id)
+    snapshot = snapshots.peek(guild_id)
+
+    if snapshot is not None:
+        snapshot.members.pop(user_id)
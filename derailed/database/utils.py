@@ -4,62 +4,42 @@
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 
-import asyncio
-from typing import TYPE_CHECKING, Any
+from datetime import datetime, timezone
+from typing import Any, Iterable
+
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
 
 from derailed.database import Invite, Member, Role, Track
 from derailed.identifier import make_invite
-from derailed.permissions import (
-    PermissionValue,
-    combine_role_permission_values,
-    has_bit,
-)
-
-
-async def get_member_roles(user_id: str, guild_id: str) -> list[Role]:
-    roles: list[Role] = []
-    member = await Member.find_one(
-        Member.user_id == user_id, Member.guild_id == guild_id
-    )
+from derailed.permissions import ADMINISTRATOR, RolePermissionEnum, has_bit
 
-    if TYPE_CHECKING and member is None:
-        raise AssertionError
+from .overwrites import get_compiled_overwrites
+from .snapshot import GuildSnapshot, get_guild_snapshot, get_member_snapshot
 
-    for role_id in member.role_ids:
-        roles.append(await Role.find_one(Role.id == role_id))
-
-    return roles
+INVITE_CODE_ATTEMPTS = 5
 
 
 async def get_member_permissions(
     user_id: str, guild_id: str, get_highest_role_position: bool = False
 ) -> int | tuple[int, int]:
-    roles = await get_member_roles(user_id=user_id, guild_id=guild_id)
-    highest_position: int = 0
-
-    values: list[PermissionValue] = []
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user_id)
 
-    for role in roles:
-        values.append(PermissionValue(position=role.position, value=role.permissions))
-
-        if role.position > highest_position:
-            highest_position = role.position
+    if member is None:
+        permissions, highest_position = 0, 0
+    else:
+        permissions = snapshot.get_permissions(member)
+        highest_position = snapshot.get_highest_position(member)
 
     if get_highest_role_position:
-        return combine_role_permission_values(*values), highest_position
+        return permissions, highest_position
 
-    return combine_role_permission_values(*values)
+    return permissions
 
 
 async def get_highest_role(guild_id: str) -> Role:
-    roles = Role.find(Role.guild_id == guild_id)
-    highest_role: Role = None
-
-    async for role in roles:
-        if role.position > highest_role.position:
-            highest_role = role
-
-    return highest_role
+    snapshot = await get_guild_snapshot(guild_id=guild_id)
+    return snapshot.get_highest_role()
 
 
 def get_track_dict(track: Track) -> dict[str, Any]:
@@ -114,24 +94,85 @@ async def get_new_track_position(guild_id: str, parent: Track | None = None) ->
     return (await get_highest_position(parent=parent, guild_id=guild_id)) + 1
 
 
-async def get_invite_code() -> str:
-    code = make_invite()
+async def insert_invite(
+    guild_id: str, track_id: str, inviter_id: str, expires_at: datetime | None
+) -> Invite:
+    # codes are random enough that a collision is rare, so the unique _id
+    # index is relied upon instead of checking with a read first.
+    for _ in range(INVITE_CODE_ATTEMPTS):
+        invite = Invite(
+            id=make_invite(),
+            guild_id=guild_id,
+            track_id=track_id,
+            inviter_id=inviter_id,
+            expires_at=expires_at,
+        )
+
+        try:
+            await invite.insert()
+        except DuplicateKeyError:
+            continue
+
+        return invite
+
+    raise HTTPException(500, 'Unable to generate an invite code')
+
+
+def get_invite_expiry(invite: Invite) -> datetime | None:
+    expires_at = invite.expires_at
 
-    if await Invite.find_one(Invite.id == code).exists():
-        return await asyncio.create_task(get_invite_code())
+    if expires_at is not None and expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
 
-    return code
+    return expires_at
+
+
+def is_invite_expired(invite: Invite) -> bool:
+    # the TTL monitor only runs once a minute, so expired invites can linger.
+    expires_at = get_invite_expiry(invite)
+
+    return expires_at is not None and expires_at <= datetime.now(timezone.utc)
+
+
+def get_invite_dict(invite: Invite) -> dict[str, Any]:
+    # stored as a date for the TTL index, but clients get unix seconds as before
+    expires_at = get_invite_expiry(invite)
+    data = invite.dict()
+    data['expires_at'] = None if expires_at is None else int(expires_at.timestamp())
+
+    return data
 
 
 def track_has_bit(value: int, visible: int, track: Track, member: Member) -> bool:
-    for overwrite in track.overwrites:
-        if (
-            overwrite.object_id == member.user_id
-            or overwrite.object_id in member.role_ids
-        ):
-            if has_bit(overwrite.allow, visible):
-                return True
-            elif has_bit(overwrite.deny, visible):
-                return False
+    return has_bit(get_compiled_overwrites(track).apply(value, member), visible)
+
 
-    return has_bit(value, visible)
+def get_visible_tracks(
+    snapshot: GuildSnapshot, member: Member, tracks: Iterable[Track]
+) -> list[Track]:
+    # the member's roles are combined once, then only overwrites differ per track
+    permissions = snapshot.get_permissions(member)
+
+    if snapshot.is_owner(member.user_id) or permissions & ADMINISTRATOR:
+        return list(tracks)
+
+    visible = RolePermissionEnum.VIEW_MESSAGE_HISTORY.value
+
+    return [
+        track
+        for track in tracks
+        if has_bit(get_compiled_overwrites(track).apply(permissions, member), visible)
+    ]
+
+
+async def get_member_visible_tracks(guild_id: str, user_id: str) -> list[Track]:
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user_id)
+
+    if member is None:
+        return []
+
+    return get_visible_tracks(
+        snapshot=snapshot,
+        member=member,
+        tracks=await Track.find(Track.guild_id == guild_id).to_list(),
+    )
@@ -3,13 +3,40 @@
 # Copyright 2022 Derailed Inc. All rights reserved.
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
-from fastapi import Header
+from fastapi import Depends, Header, HTTPException, Request
 
-from derailed.database import User, verify_token
+from derailed.database import TrackContext, User, load_track_context, verify_token
+from derailed.exceptions import NoAuthorizationError
 
 
-async def get_user(authorization: str | None = Header(None)) -> User | None:
-    if authorization is None:
-        return None
+async def get_user(
+    request: Request, authorization: str | None = Header(None)
+) -> User | None:
+    # the rate limiter and the route share this, so only verify once per request.
+    if hasattr(request.state, 'user'):
+        return request.state.user
 
-    return await verify_token(token=authorization)
+    user = None if authorization is None else await verify_token(token=authorization)
+    request.state.user = user
+
+    return user
+
+
+async def get_track_context(
+    track_id: str, user: User | None = Depends(get_user)
+) -> TrackContext:
+    if user is None:
+        raise NoAuthorizationError()
+
+    context = await load_track_context(track_id=track_id, user=user)
+
+    if context is None:
+        raise HTTPException(404, 'Track not found')
+
+    if not context.is_member:
+        if context.track.guild_id is None:
+            raise HTTPException(403, 'You are not a member of this track')
+
+        raise HTTPException(403, 'You are not a member of this guild')
+
+    return context
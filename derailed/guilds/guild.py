@@ -6,12 +6,12 @@
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from pydantic import BaseModel, Field
 
+from derailed.codec import respond
 from derailed.database import (
     Event,
     Guild,
     Invite,
     Member,
-    Message,
     Pin,
     Role,
     Track,
@@ -20,10 +20,12 @@ from derailed.database import (
     get_member_permissions,
     produce,
 )
+from derailed.database.messages import message_store
 from derailed.depends import get_user
 from derailed.exceptions import NoAuthorizationError
 from derailed.identifier import make_snowflake
 from derailed.permissions import RolePermissionEnum, has_bit
+from derailed.reads import secondary_reads
 
 router = APIRouter(prefix='/guilds')
 
@@ -85,13 +87,13 @@ async def create_guild(
     return guild.dict()
 
 
-@router.get('/{guild_id}', status_code=200)
+@router.get('/{guild_id}', status_code=200, dependencies=[secondary_reads])
 async def get_guild(
     guild_id: str,
     request: Request,
     response: Response,
     user: User | None = Depends(get_user),
-) -> dict:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
@@ -103,16 +105,16 @@ async def get_guild(
         raise HTTPException(403, 'You are not a member of this guild')
 
     guild = await Guild.find_one(Guild.id == guild_id)
-    return guild.dict()
+    return respond(guild.dict(), request, response)
 
 
-@router.get('/{guild_id}/preview', status_code=200)
+@router.get('/{guild_id}/preview', status_code=200, dependencies=[secondary_reads])
 async def get_guild_preview(
     guild_id: str,
     request: Request,
     response: Response,
     user: User | None = Depends(get_user),
-) -> dict:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
@@ -130,7 +132,7 @@ async def get_guild_preview(
     # TODO: Actually find a way to count this
     guildd['online_count'] = 0
 
-    return guild.dict()
+    return respond(guildd, request, response)
 
 
 @router.patch('/{guild_id}', status_code=200)
@@ -207,7 +209,7 @@ async def delete_guild(
 
     async for track in tracks:
         await track.delete()
-        await Message.find(Message.track_id == track.id).delete()
+        await message_store.delete_track(track.id)
         await Pin.find(Pin.origin == track.id).delete()
 
     await Role.find(Role.guild_id == guild.id).delete()
@@ -4,11 +4,9 @@
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 
-from time import time
-from typing import Any
-
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
+from derailed.codec import respond
 from derailed.database import (
     Event,
     Guild,
@@ -17,48 +15,49 @@ from derailed.database import (
     Track,
     User,
     get_date,
+    get_invite_dict,
     get_member_permissions,
+    is_invite_expired,
     produce,
 )
 from derailed.depends import get_user
 from derailed.exceptions import NoAuthorizationError
 from derailed.permissions import RolePermissionEnum, has_bit
 from derailed.rate_limit import rate_limiter
+from derailed.reads import secondary_reads
 
 router = APIRouter()
 
 
-@router.get('/invites/{invite_code}')
-@rate_limiter.limit('10/second')
+@router.get(
+    '/invites/{invite_code}',
+    dependencies=[rate_limiter.limit('10/second'), secondary_reads],
+)
 async def get_invite(
     invite_code: str, request: Request, response: Response
-) -> dict[str, Any]:
+) -> Response:
     invite = await Invite.find_one(Invite.id == invite_code)
 
     if invite is None:
         raise HTTPException(404, 'Invite not found')
 
-    if invite.expires_at and invite.expires_at < int(time()):
-        # NOTE: This is a really convoluted way of deleting invites
-        # any better way?
-        await invite.delete()
+    if is_invite_expired(invite):
         raise HTTPException(400, 'This invite has expired')
 
     guild = await Guild.find_one(Guild.id == invite.guild_id)
     track = await Track.find_one(Track.id == invite.track_id)
     inviter = await User.find_one(User.id == invite.inviter_id)
 
-    ret = invite.dict()
+    ret = get_invite_dict(invite)
 
     ret['guild'] = guild.dict()
     ret['track'] = track.dict(include={'id', 'name', 'type'})
     ret['inviter'] = inviter.dict(exclude={'email', 'password', 'verification'})
 
-    return ret
+    return respond(ret, request, response)
 
 
-@router.post('/invites/{invite_code}')
-@rate_limiter.limit('3/second')
+@router.post('/invites/{invite_code}', dependencies=[rate_limiter.limit('3/second')])
 async def accept_invite(
     invite_code: str,
     request: Request,
@@ -73,10 +72,7 @@ async def accept_invite(
     if invite is None:
         raise HTTPException(404, 'Invite not found')
 
-    if invite.expires_at and invite.expires_at < int(time()):
-        # NOTE: This is a really convoluted way of deleting invites
-        # any better way?
-        await invite.delete()
+    if is_invite_expired(invite):
         raise HTTPException(400, 'This invite has expired')
 
     if await Member.find_one(
@@ -119,10 +115,7 @@ async def delete_invite(
     if invite is None:
         raise HTTPException(404, 'Invite not found')
 
-    if invite.expires_at is None or invite.expires_at < int(time()):
-        # NOTE: This is a really convoluted way of deleting invites
-        # any better way?
-        await invite.delete()
+    if is_invite_expired(invite):
         raise HTTPException(400, 'This invite has expired')
 
     guild = await Guild.find_one(Guild.id == invite.guild_id)
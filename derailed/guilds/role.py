@@ -4,114 +4,114 @@
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 import itertools
-from typing import TYPE_CHECKING, Any
+from typing import Any
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from pydantic import BaseModel, Field
 
+from derailed.codec import Body, check_length, read_body, respond
 from derailed.database import (
     Event,
-    Guild,
     Member,
     Role,
     User,
     get_highest_role,
-    get_member_permissions,
+    get_member_snapshot,
     produce,
 )
 from derailed.depends import get_user
 from derailed.exceptions import NoAuthorizationError
 from derailed.identifier import make_snowflake
 from derailed.permissions import RolePermissionEnum, has_bit
+from derailed.reads import secondary_reads
 
 router = APIRouter()
 
 
-class CreateRole(BaseModel):
-    name: str = Field(max_length=128)
-    hoist: bool = False
+class CreateRole(Body):
+    name: str
     permissions: int
+    hoist: bool = False
+
+    def check(self) -> None:
+        check_length('name', self.name, max_length=128)
 
 
-class ModifyRole(BaseModel):
-    name: str | None = Field(None, max_length=128)
-    hoist: bool | None = Field(None)
-    position: int | None = Field(None)
-    permissions: int | None = Field(None)
+class ModifyRole(Body):
+    name: str | None = None
+    hoist: bool | None = None
+    position: int | None = None
+    permissions: int | None = None
 
+    def check(self) -> None:
+        check_length('name', self.name, max_length=128)
 
-@router.get('/guilds/{guild_id}/roles', status_code=200)
+
+@router.get('/guilds/{guild_id}/roles', status_code=200, dependencies=[secondary_reads])
 async def get_guild_roles(
     guild_id: str,
     request: Request,
     response: Response,
     user: User | None = Depends(get_user),
-) -> list[Role]:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    is_member = await Member.find_one(
-        Member.guild_id == guild_id, Member.user_id == user.id
-    ).exists()
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
 
-    if not is_member:
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
-    roles = await Role.find(Role.guild_id == guild_id).to_list()
-
-    return roles
+    return respond([role.dict() for role in snapshot.roles.values()], request, response)
 
 
-@router.get('/guilds/{guild_id}/roles/{role_id}', status_code=200)
+@router.get(
+    '/guilds/{guild_id}/roles/{role_id}',
+    status_code=200,
+    dependencies=[secondary_reads],
+)
 async def get_guild_role(
     guild_id: str,
     role_id: str,
     request: Request,
     response: Response,
     user: User | None = Depends(get_user),
-) -> list[Role]:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    is_member = await Member.find_one(
-        Member.guild_id == guild_id, Member.user_id == user.id
-    ).exists()
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
 
-    if not is_member:
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
-    role = await Role.find_one(Role.guild_id == guild_id, Role.id == role_id)
+    role = snapshot.roles.get(role_id)
 
-    if TYPE_CHECKING and not role:
-        raise AssertionError
+    if role is None:
+        raise HTTPException(404, 'Role does not exist')
 
-    return role
+    return respond(role.dict(), request, response)
 
 
 @router.post('/guilds/{guild_id}/roles', status_code=201)
 async def create_role(
     guild_id: str,
-    model: CreateRole,
     request: Request,
     response: Response,
+    model: CreateRole = Depends(read_body(CreateRole)),
     user: User | None = Depends(get_user),
-) -> dict:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    is_member = await Member.find_one(
-        Member.guild_id == guild_id, Member.user_id == user.id
-    ).exists()
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
 
-    if not is_member:
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
     # TODO: don't let users set the roles permission higher than their own
-    guild = await Guild.find_one(Guild.id == guild_id)
+    is_owner = snapshot.is_owner(user.id)
 
-    is_owner = user.id == guild.owner_id
-
-    permissions = await get_member_permissions(user_id=user.id, guild_id=guild_id)
+    permissions = snapshot.get_permissions(member)
 
     if not has_bit(permissions, RolePermissionEnum.MANAGE_ROLES.value) and not is_owner:
         raise HTTPException(403, 'Invalid permissions')
@@ -123,12 +123,8 @@ async def create_role(
                     400, 'You cannot assign roles a permission you don\'t have'
                 )
 
-    if await Role.find_one(
-        Role.guild_id == guild_id, Role.position == model.position
-    ).exists():
-        raise HTTPException(400, 'Role position already taken')
-
-    highest = await get_highest_role(guild_id=guild_id)
+    # new roles always go above every other role
+    highest = snapshot.get_highest_role()
 
     role = Role(
         id=make_snowflake(),
@@ -136,69 +132,78 @@ async def create_role(
         name=model.name,
         hoist=model.hoist,
         permissions=model.permissions,
-        position=highest.position + 1,
+        position=(highest.position if highest is not None else 0) + 1,
     )
     await role.insert()
 
     data = role.dict()
 
     await produce('guild', Event('ROLE_CREATE', data, guild_id=guild_id))
-    return data
+    return respond(data, request, response, status_code=201)
 
 
 async def get_position(guild_id: str, role: Role, position: int) -> None:
-    if position in {0, 1}:
+    # 0 and 1 are kept for the everyone role, and nothing goes below them
+    if position < 2:
         raise HTTPException(400, 'Cannot designate role position')
 
     highest = await get_highest_role(guild_id=guild_id)
 
-    if position > highest.position and position != highest + 1:
+    if position > highest.position + 1:
         raise HTTPException(400, 'Position value is too big')
 
-    if position == highest.position + 1:
-        await role.update(position=highest.position + 1)
-        return
-
-    roles = Role.find(Role.guild_id == guild_id)
+    # one past the top is the top, once this role has left its old position
+    position = min(position, highest.position)
 
-    async for grole in roles:
-        if grole.position > position:
-            await grole.update(position=grole.position + 1)
-        elif grole.position == position:
-            await grole.update(position=grole.position + 1)
-            break
-        else:
-            await grole.update(position=grole.position - 1)
+    if position == role.position:
+        return
 
-    await role.update(position=position)
+    # the roles between the old and new position shift over by one to make room,
+    # in the same update which moves this role, so a failure can't leave two
+    # roles sharing a position.
+    low, high = sorted((role.position, position))
+    shift = -1 if position > role.position else 1
+
+    await Role.get_motor_collection().update_many(
+        {'guild_id': guild_id, 'position': {'$gte': low, '$lte': high}},
+        [
+            {
+                '$set': {
+                    'position': {
+                        '$cond': [
+                            {'$eq': ['$_id', role.id]},
+                            position,
+                            {'$add': ['$position', shift]},
+                        ]
+                    }
+                }
+            }
+        ],
+    )
+    role.position = position
 
 
 @router.patch('/guilds/{guild_id}/roles/{role_id}', status_code=200)
 async def modify_role(
     guild_id: str,
     role_id: str,
-    model: ModifyRole,
     request: Request,
     response: Response,
+    model: ModifyRole = Depends(read_body(ModifyRole)),
     user: User | None = Depends(get_user),
-) -> dict:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    is_member = await Member.find_one(
-        Member.guild_id == guild_id, Member.user_id == user.id
-    ).exists()
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
 
-    if not is_member:
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
-    permissions, max_pos = await get_member_permissions(
-        user_id=user.id, guild_id=guild_id, get_highest_role_position=True
-    )
+    permissions = snapshot.get_permissions(member)
+    max_pos = snapshot.get_highest_position(member)
 
-    guild = await Guild.find_one(Guild.id == guild_id)
-
-    is_owner = user.id == guild.owner_id
+    is_owner = snapshot.is_owner(user.id)
 
     if not has_bit(permissions, RolePermissionEnum.MANAGE_ROLES.value) and not is_owner:
         raise HTTPException(403, 'Invalid permissions')
@@ -216,12 +221,6 @@ async def modify_role(
     if model.hoist is not None:
         updates['hoist'] = model.hoist
 
-    if model.position is not None:
-        if role.position > max_pos and not is_owner:
-            raise HTTPException(400, 'Role position is over your own role permission.')
-
-        await get_position(guild_id=guild_id, role=role, position=model.position)
-
     if model.permissions is not None:
         for value in RolePermissionEnum:
             if has_bit(model.permissions, value) and not has_bit(permissions, value):
@@ -229,12 +228,21 @@ async def modify_role(
                     400, 'You cannot assign roles a permission you don\'t have'
                 )
 
-    await role.update(**updates)
+        updates['permissions'] = model.permissions
+
+    if model.position is not None:
+        if role.position > max_pos and not is_owner:
+            raise HTTPException(400, 'Role position is over your own role permission.')
+
+        await get_position(guild_id=guild_id, role=role, position=model.position)
+
+    if updates:
+        await role.set(updates)
 
     data = role.dict()
 
     await produce('guild', Event('ROLE_EDIT', data, guild_id=guild_id))
-    return data
+    return respond(data, request, response)
 
 
 @router.delete('/guilds/{guild_id}/roles/{role_id}', status_code=204)
@@ -248,20 +256,15 @@ async def delete_guild_role(
     if user is None:
         raise NoAuthorizationError()
 
-    is_member = await Member.find_one(
-        Member.guild_id == guild_id, Member.user_id == user.id
-    ).exists()
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
 
-    if not is_member:
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
-    permissions, max_pos = await get_member_permissions(
-        user_id=user.id, guild_id=guild_id, get_highest_role_position=True
-    )
-
-    guild = await Guild.find_one(Guild.id == guild_id)
+    permissions = snapshot.get_permissions(member)
+    max_pos = snapshot.get_highest_position(member)
 
-    is_owner = user.id == guild.owner_id
+    is_owner = snapshot.is_owner(user.id)
 
     if not has_bit(permissions, RolePermissionEnum.MANAGE_ROLES.value) and not is_owner:
         raise HTTPException(403, 'Invalid permissions')
@@ -36,6 +36,16 @@ def make_snowflake() -> str:
     return str(epoch)
 
 
+def snowflake_bound(unix_ms: int, upper: bool = False) -> str:
+    """The lowest, or highest, snowflake which could be made at `unix_ms`."""
+    snowflake = max(unix_ms - EPOCH, 0) << 22
+
+    if upper:
+        snowflake |= (1 << 22) - 1
+
+    return str(snowflake)
+
+
 def make_invite() -> str:
     return secrets.token_urlsafe(randint(4, 7))
 
@@ -0,0 +1,59 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Iterator
+
+
+class LatencyStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+    def dict(self) -> dict[str, Any]:
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'average_ms': self.total * 1000 / self.count if self.count else 0.0,
+            'max_ms': self.max * 1000,
+        }
+
+
+# per-worker operation name -> latency
+latencies: dict[str, LatencyStats] = {}
+
+
+def observe(name: str, seconds: float) -> None:
+    stats = latencies.get(name)
+
+    if stats is None:
+        stats = latencies[name] = LatencyStats()
+
+    stats.observe(seconds)
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    start = perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start)
+
+
+def get_latencies() -> dict[str, dict[str, Any]]:
+    return {name: stats.dict() for name, stats in latencies.items()}
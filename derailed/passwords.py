@@ -0,0 +1,81 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+from fastapi import HTTPException
+
+from derailed.metrics import timed
+
+# argon2 takes tens of milliseconds of CPU, which must never run on the event loop.
+PASSWORD_EXECUTOR = os.getenv('PASSWORD_EXECUTOR', 'process')
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', 2))
+# operations allowed to be running or waiting at once, and how long to wait for one
+PASSWORD_QUEUE_SIZE = int(os.getenv('PASSWORD_QUEUE_SIZE', 32))
+PASSWORD_QUEUE_TIMEOUT = float(os.getenv('PASSWORD_QUEUE_TIMEOUT', 5))
+
+ph = PasswordHasher()
+
+_executor: Executor | None = None
+_slots = asyncio.Semaphore(PASSWORD_QUEUE_SIZE)
+
+
+def get_executor() -> Executor:
+    # created lazily so every gunicorn worker gets its own pool after forking.
+    global _executor
+
+    if _executor is None:
+        if PASSWORD_EXECUTOR == 'thread':
+            _executor = ThreadPoolExecutor(
+                max_workers=PASSWORD_WORKERS, thread_name_prefix='passwords'
+            )
+        else:
+            # forking a worker which already has threads and sockets open can
+            # deadlock the children, so they come from a clean server process.
+            _executor = ProcessPoolExecutor(
+                max_workers=PASSWORD_WORKERS,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+
+    return _executor
+
+
+def _hash(password: str) -> str:
+    return ph.hash(password)
+
+
+def _verify(hashed: str, password: str) -> bool:
+    try:
+        return ph.verify(hashed, password)
+    except (VerificationError, InvalidHash):
+        return False
+
+
+async def _run(operation: str, func, *args):
+    try:
+        await asyncio.wait_for(_slots.acquire(), timeout=PASSWORD_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, 'Too many requests are being processed, try again')
+
+    try:
+        with timed(f'password.{operation}'):
+            return await asyncio.get_running_loop().run_in_executor(
+                get_executor(), func, *args
+            )
+    finally:
+        _slots.release()
+
+
+async def hash_password(password: str) -> str:
+    return await _run('hash', _hash, password)
+
+
+async def verify_password(hashed: str, password: str) -> bool:
+    return await _run('verify', _verify, hashed, password)
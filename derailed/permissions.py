@@ -3,16 +3,17 @@
 # Copyright 2022 Derailed Inc. All rights reserved.
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
-import itertools
-
-# NOTE: enums in the standard python implementation aren't really the fastest.
-# is there a better way to do this?
 from enum import IntFlag
-from typing import TypedDict
+from typing import Iterable, TypedDict
+
+try:
+    import numpy  # type: ignore
+except ImportError:
+    numpy = None
 
 
 def has_bit(value: int, visible: int) -> bool:
-    return True if value & 1 << 9 else bool(value & visible)
+    return True if value & ADMINISTRATOR else bool(value & visible)
 
 
 class PermissionValue(TypedDict):
@@ -38,23 +39,45 @@ class RolePermissionEnum(IntFlag):
     DELETE_INVITES = 1 << 14
 
 
-def combine_role_permission_values(*permission_values: PermissionValue):
-    modified_value = 0
-    _internal = []
+# NOTE: enums in the standard python implementation aren't really the fastest,
+# so everything below works on plain integers.
+ADMINISTRATOR: int = RolePermissionEnum.ADMINISTRATOR.value
+ALL_PERMISSIONS: int = sum(permission.value for permission in RolePermissionEnum)
+
+
+def combine_permissions(values: Iterable[int]) -> int:
+    """
+    A member has every permission any of their roles grants, so the masks are
+    ORed and role positions don't matter. The old IntFlag loop instead ended on
+    whichever role it inserted last, which is why positions used to be passed.
+    """
+    combined = 0
+
+    for value in values:
+        if value & ADMINISTRATOR:
+            return ALL_PERMISSIONS
+
+        combined |= value
+
+    return combined
+
+
+def combine_role_permission_values(*permission_values: PermissionValue) -> int:
+    return combine_permissions(value['value'] for value in permission_values)
+
 
-    for value in permission_values:
-        _internal.insert(value['position'], value['value'])
+def or_segments(flat: 'numpy.ndarray', lengths: 'numpy.ndarray') -> 'numpy.ndarray':
+    """
+    ORs `flat` together in consecutive runs of `lengths`, with 0 for empty runs.
+    Needs numpy, which callers check for before taking their batched path.
+    """
+    offsets = numpy.zeros(len(lengths), dtype=numpy.int64)
+    numpy.cumsum(lengths[:-1], out=offsets[1:])
 
-    for value, permission_value in itertools.product(_internal, RolePermissionEnum):
-        if has_bit(modified_value, permission_value.value) and not has_bit(
-            value, permission_value.value
-        ):
-            modified_value -= permission_value.value
-        elif not has_bit(modified_value, permission_value.value) and has_bit(
-            value, permission_value.value
-        ):
-            modified_value |= permission_value.value
-        else:
-            continue
+    # a trailing 0 keeps every offset, even those of empty runs at the end,
+    # inside the array without changing what the last run folds to. reduceat
+    # gives empty runs their neighbour's value, so they are masked out after.
+    folded = numpy.bitwise_or.reduceat(numpy.append(flat, 0), offsets)
+    folded[lengths == 0] = 0
 
-    return modified_value
+    return folded
@@ -3,32 +3,256 @@
 # Copyright 2022 Derailed Inc. All rights reserved.
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
+import asyncio
+import logging
 import os
+import time
+from typing import Callable
 
-from fastapi import Depends, Request
-from slowapi import Limiter
-from slowapi.util import get_ipaddr
+from fastapi import Depends, HTTPException, Request, Response
 
-from derailed.database import User
-from derailed.depends import get_user
+from derailed.database import get_verified_user_id
+from derailed.storage import MemoryStorage, RedisStorage, storage
 
+# how often (in seconds) hybrid limits reconcile with storage, and how much of a
+# limit a worker may spend on its own before it has to reconcile right away.
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv('RATE_LIMIT_SYNC_INTERVAL', 0.05))
+RATE_LIMIT_MAX_DRIFT = float(os.getenv('RATE_LIMIT_MAX_DRIFT', 0.25))
 
-async def get_rate_limit_key(
-    request: Request, user: User | None = Depends(get_user)
-) -> str:
-    return get_ipaddr(request=request) if user is None else user.id
+logger = logging.getLogger(__name__)
+
+PERIODS: dict[str, int] = {
+    'second': 1,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+
+def get_ipaddr(request: Request) -> str:
+    forwarded_for = request.headers.get('x-forwarded-for')
+
+    if forwarded_for:
+        return forwarded_for.split(',')[0].strip()
+
+    return request.client.host if request.client else '127.0.0.1'
+
+
+def get_rate_limit_key(request: Request) -> str:
+    # NOTE: limits are checked before the route's dependencies run, so this
+    # must never touch the database.
+    user = getattr(request.state, 'user', None)
+
+    if user is not None:
+        return user.id
+
+    authorization = request.headers.get('authorization')
+
+    if authorization is not None:
+        user_id = get_verified_user_id(token=authorization)
+
+        if user_id is not None:
+            return user_id
+
+    return get_ipaddr(request=request)
+
+
+class RateLimit:
+    def __init__(self, limiter: 'Limiter', limit: str, scope: str | None) -> None:
+        amount, _, period = limit.partition('/')
+
+        self.limiter = limiter
+        self.limit = limit
+        self.amount = int(amount)
+        self.period = PERIODS[period.strip()]
+        self.scope = scope
+
+    def get_key(self, request: Request) -> str:
+        # unshared limits are scoped to the route they are on
+        scope = self.scope or request.scope['endpoint'].__name__
+
+        return f'LIMITER/{scope}/{self.limiter.key_func(request)}/{self.limit}'
+
+    async def __call__(self, request: Request, response: Response) -> None:
+        count, ttl = await self.limiter.storage.hit(
+            self.get_key(request), self.period, elastic=self.limiter.elastic
+        )
+        remaining = max(self.amount - count, 0)
+        reset = int(time.time()) + max(ttl, 0)
+
+        headers = {
+            'X-RateLimit-Limit': str(self.amount),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(reset),
+        }
+
+        if count > self.amount:
+            headers['Retry-After'] = str(max(ttl, 0))
+            raise HTTPException(
+                429, f'Rate limit exceeded: {self.limit}', headers=headers
+            )
+
+        if self.limiter.headers_enabled:
+            response.headers.update(headers)
+
+
+class LocalBucket:
+    __slots__ = ('shared', 'pending')
+
+    def __init__(self) -> None:
+        # the last count seen in storage, and hits storage hasn't seen yet
+        self.shared = 0
+        self.pending = 0
+
+
+class HybridRateLimit(RateLimit):
+    """A fixed window limit spent locally and reconciled with storage in batches."""
+
+    def __init__(self, limiter: 'Limiter', limit: str, scope: str | None) -> None:
+        super().__init__(limiter, limit, scope)
+
+        self.max_drift = max(1, int(self.amount * RATE_LIMIT_MAX_DRIFT))
+        self.buckets: dict[tuple[str, int], LocalBucket] = {}
+        self._sync_task: asyncio.Task | None = None
+
+    async def __call__(self, request: Request, response: Response) -> None:
+        if self._sync_task is None or self._sync_task.done():
+            self._sync_task = asyncio.create_task(self.sync_forever())
+
+        window = int(time.time() // self.period)
+        key = (self.get_key(request), window)
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            bucket = self.buckets[key] = LocalBucket()
+
+        count = bucket.shared + bucket.pending + 1
+        reset = (window + 1) * self.period
+
+        headers = {
+            'X-RateLimit-Limit': str(self.amount),
+            'X-RateLimit-Remaining': str(max(self.amount - count, 0)),
+            'X-RateLimit-Reset': str(reset),
+        }
+
+        if count > self.amount:
+            headers['Retry-After'] = str(max(reset - int(time.time()), 1))
+            raise HTTPException(
+                429, f'Rate limit exceeded: {self.limit}', headers=headers
+            )
+
+        bucket.pending += 1
+
+        if bucket.pending >= self.max_drift:
+            try:
+                await self.sync([key])
+            except Exception:
+                # the hit stays pending, and the local count is used until
+                # storage is back
+                logger.warning('Failed to sync rate limit %s', key, exc_info=True)
+
+        if self.limiter.headers_enabled:
+            response.headers.update(headers)
+
+    def get_storage_key(self, key: tuple[str, int]) -> str:
+        return f'{key[0]}/{key[1]}'
+
+    async def sync(self, keys: list[tuple[str, int]]) -> None:
+        buckets = [self.buckets[key] for key in keys]
+        pending = [bucket.pending for bucket in buckets]
+
+        for bucket in buckets:
+            bucket.pending = 0
+
+        try:
+            counts = await self.limiter.storage.incr_many(
+                [
+                    (self.get_storage_key(key), amount, self.period * 2)
+                    for key, amount in zip(keys, pending)
+                ]
+            )
+        except Exception:
+            for bucket, amount in zip(buckets, pending):
+                bucket.pending += amount
+
+            raise
+
+        # counts only grow within a window, so one from a sync which finished
+        # late never replaces a newer one.
+        for bucket, count in zip(buckets, counts):
+            bucket.shared = max(bucket.shared, count)
+
+    async def refresh(self, keys: list[tuple[str, int]]) -> None:
+        """Picks up other workers' hits on buckets this worker has none to add to."""
+        counts = await self.limiter.storage.get_many(
+            [self.get_storage_key(key) for key in keys]
+        )
+
+        for key, count in zip(keys, counts):
+            bucket = self.buckets.get(key)
+
+            if bucket is not None and count is not None:
+                bucket.shared = max(bucket.shared, int(count))
+
+    async def sync_forever(self) -> None:
+        while True:
+            await asyncio.sleep(RATE_LIMIT_SYNC_INTERVAL)
+
+            window = int(time.time() // self.period)
+
+            for key in [key for key in self.buckets if key[1] < window]:
+                del self.buckets[key]
+
+            # buckets with hits to add are written in one pipeline, and idle ones
+            # only read, all with one command.
+            pending = [key for key, bucket in self.buckets.items() if bucket.pending]
+            idle = [key for key, bucket in self.buckets.items() if not bucket.pending]
+
+            try:
+                if pending:
+                    await self.sync(pending)
+
+                if idle:
+                    await self.refresh(idle)
+            except Exception:
+                # a storage hiccup must not end reconciliation for good
+                logger.exception('Failed to sync rate limits')
+
+
+class Limiter:
+    def __init__(
+        self,
+        key_func: Callable[[Request], str],
+        storage: MemoryStorage | RedisStorage,
+        headers_enabled: bool = False,
+        strategy: str = 'fixed-window',
+    ) -> None:
+        if strategy not in ('fixed-window', 'fixed-window-elastic-expiry'):
+            raise ValueError(f'Unsupported rate limit strategy {strategy!r}')
+
+        self.key_func = key_func
+        self.storage = storage
+        self.headers_enabled = headers_enabled
+        self.elastic = strategy == 'fixed-window-elastic-expiry'
+
+    def limit(self, limit: str, hybrid: bool = False) -> Depends:
+        cls = HybridRateLimit if hybrid else RateLimit
+        return Depends(cls(self, limit, scope=None))
+
+    def shared_limit(self, limit: str, scope: str, hybrid: bool = False) -> Depends:
+        cls = HybridRateLimit if hybrid else RateLimit
+        return Depends(cls(self, limit, scope=scope))
 
 
 def get_limiter() -> Limiter:
     return Limiter(
         key_func=get_rate_limit_key,
-        default_limits=['50/second'],
+        storage=storage,
         headers_enabled=True,
         strategy='fixed-window-elastic-expiry',
-        storage_uri=os.getenv('STORAGE_URI'),
     )
 
 
 rate_limiter = get_limiter()
 
-track_limit = rate_limiter.shared_limit('20/second', 'track_id')
+track_limit = rate_limiter.shared_limit('20/second', 'track_id', hybrid=True)
@@ -0,0 +1,114 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import logging
+import os
+
+from fastapi import Depends, Request
+from pymongo.read_preferences import (
+    _ServerMode,
+    make_read_preference,
+    read_pref_mode_from_name,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from derailed.cache import TTLCache
+from derailed.database import Event, User, listen, produce, read_preference
+from derailed.depends import get_user
+
+# what routes depending on `secondary_reads` read with. `primary` turns it off.
+SECONDARY_READ_PREFERENCE = os.getenv('SECONDARY_READ_PREFERENCE', 'secondaryPreferred')
+# in seconds, at least 90 when set
+SECONDARY_MAX_STALENESS = int(os.getenv('SECONDARY_MAX_STALENESS', -1))
+# how long, in seconds, a client reads from the primary after it writes something
+READ_STICKINESS = int(os.getenv('READ_STICKINESS', 15))
+# how many recent writers each worker remembers
+READ_STICKY_CACHE_SIZE = int(os.getenv('READ_STICKY_CACHE_SIZE', 100000))
+
+logger = logging.getLogger(__name__)
+
+# ids of the users who wrote something in the last READ_STICKINESS seconds, on
+# any worker.
+recent_writers: TTLCache[str, bool] = TTLCache(
+    max_size=READ_STICKY_CACHE_SIZE, ttl=READ_STICKINESS
+)
+
+
+def get_secondary_preference() -> _ServerMode | None:
+    if SECONDARY_READ_PREFERENCE == 'primary':
+        return None
+
+    return make_read_preference(
+        read_pref_mode_from_name(SECONDARY_READ_PREFERENCE),
+        tag_sets=None,
+        max_staleness=SECONDARY_MAX_STALENESS,
+    )
+
+
+secondary_preference = get_secondary_preference()
+
+
+async def use_secondaries(
+    request: Request, user: User | None = Depends(get_user)
+) -> None:
+    # the user is verified from the primary first, so a fresh account or token
+    # is never rejected by a secondary which hasn't seen it yet.
+    if secondary_preference is None:
+        return
+
+    if user is None or recent_writers.get(user.id) is None:
+        read_preference.set(secondary_preference)
+
+
+secondary_reads = Depends(use_secondaries)
+
+
+@listen('reads', 'USER_WRITE')
+def remember_writer(event: Event) -> None:
+    recent_writers.set(event.user_id, True)
+
+
+class StickyWrites:
+    """
+    Keeps a user on the primary for a while after they change something.
+
+    Successful writes are announced to every worker once the response is sent,
+    so the next read goes to the primary wherever it lands, whatever the client
+    keeps between requests.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope['type'] != 'http'
+            or secondary_preference is None
+            or scope['method'] in ('GET', 'HEAD', 'OPTIONS')
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message: Message) -> None:
+            nonlocal status
+
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+            await send(message)
+
+        await self.app(scope, receive, send_status)
+
+        # `get_user` leaves the user on the request state
+        user = scope.get('state', {}).get('user')
+
+        if status < 400 and user is not None:
+            try:
+                await produce('reads', Event('USER_WRITE', {}, user_id=user.id))
+            except Exception:
+                # this user may read their write back stale, but it's saved
+                logger.warning('Failed to mark %s as a writer', user.id, exc_info=True)
@@ -0,0 +1,136 @@
+# The Derailed API
+#
+# Copyright 2022 Derailed Inc. All rights reserved.
+#
+# Sharing of any piece of code to any unauthorized third-party is not allowed.
+import math
+import os
+from time import monotonic
+from typing import Any
+
+from redis import asyncio as aioredis
+
+# Increments a fixed window counter, (re)arming its expiry when the window is
+# new or when the expiry is elastic. Returns the new count and remaining ttl.
+HIT_SCRIPT = '''
+local current = redis.call('incrby', KEYS[1], ARGV[2])
+if current == tonumber(ARGV[2]) or ARGV[3] == '1' then
+    redis.call('expire', KEYS[1], ARGV[1])
+end
+return {current, redis.call('ttl', KEYS[1])}
+'''
+
+
+class MemoryStorage:
+    """A per-process stand-in for Redis, used when `STORAGE_URI` is not set."""
+
+    # seconds between sweeps for expired keys which are never read again
+    sweep_interval = 10
+
+    def __init__(self) -> None:
+        self._data: dict[str, Any] = {}
+        self._expiries: dict[str, float] = {}
+        self._next_sweep = monotonic() + self.sweep_interval
+
+    def _expire(self, key: str) -> None:
+        expires_at = self._expiries.get(key)
+
+        if expires_at is not None and expires_at <= monotonic():
+            self._data.pop(key, None)
+            del self._expiries[key]
+
+    def _sweep(self) -> None:
+        now = monotonic()
+
+        if now < self._next_sweep:
+            return
+
+        self._next_sweep = now + self.sweep_interval
+
+        expired = [
+            key for key, expires_at in self._expiries.items() if expires_at <= now
+        ]
+
+        for key in expired:
+            self._data.pop(key, None)
+            del self._expiries[key]
+
+    async def get(self, key: str) -> str | None:
+        self._expire(key)
+        value = self._data.get(key)
+        return None if value is None else str(value)
+
+    async def get_many(self, keys: list[str]) -> list[str | None]:
+        return [await self.get(key) for key in keys]
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        self._sweep()
+        self._expire(key)
+        value = int(self._data.get(key, 0)) + amount
+        self._data[key] = value
+        return value
+
+    async def hit(
+        self, key: str, expiry: int, amount: int = 1, elastic: bool = False
+    ) -> tuple[int, int]:
+        current = await self.incr(key, amount)
+
+        if current == amount or elastic:
+            self._expiries[key] = monotonic() + expiry
+
+        return current, math.ceil(self._expiries[key] - monotonic())
+
+    async def incr_many(self, items: list[tuple[str, int, int]]) -> list[int]:
+        counts: list[int] = []
+
+        for key, amount, expiry in items:
+            counts.append(await self.incr(key, amount))
+            self._expiries.setdefault(key, monotonic() + expiry)
+
+        return counts
+
+
+class RedisStorage:
+    def __init__(self, uri: str) -> None:
+        self.redis = aioredis.from_url(uri, decode_responses=True)
+        self._hit = self.redis.register_script(HIT_SCRIPT)
+
+    async def get(self, key: str) -> str | None:
+        return await self.redis.get(key)
+
+    async def get_many(self, keys: list[str]) -> list[str | None]:
+        return await self.redis.mget(keys)
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        return await self.redis.incrby(key, amount)
+
+    async def hit(
+        self, key: str, expiry: int, amount: int = 1, elastic: bool = False
+    ) -> tuple[int, int]:
+        current, ttl = await self._hit(
+            keys=[key], args=[expiry, amount, '1' if elastic else '0']
+        )
+        return int(current), int(ttl)
+
+    async def incr_many(self, items: list[tuple[str, int, int]]) -> list[int]:
+        # one round trip for every (key, amount, expiry), without a transaction
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, amount, expiry in items:
+                pipe.incrby(key, amount)
+                pipe.expire(key, expiry)
+
+            results = await pipe.execute()
+
+        return [int(count) for count in results[::2]]
+
+
+def get_storage() -> MemoryStorage | RedisStorage:
+    uri = os.getenv('STORAGE_URI')
+
+    if not uri or uri.startswith('memory://'):
+        return MemoryStorage()
+
+    return RedisStorage(uri)
+
+
+storage = get_storage()
@@ -22,8 +22,7 @@ class CreateGroupDM(BaseModel):
     user_ids: list[str] = Field(min_items=2, max_items=20)
 
 
-@router.post('/users/@me/group-dms', status_code=201)
-@track_limit
+@router.post('/users/@me/group-dms', status_code=201, dependencies=[track_limit])
 async def create_group_dm(
     model: CreateGroupDM,
     request: Request,
@@ -4,23 +4,24 @@
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
 
+from datetime import datetime, timezone
 from time import time
 from typing import Any, Literal
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from pydantic import BaseModel, Field
+from pydantic import BaseModel
 
+from derailed.codec import Body, check_length, read_body, respond
 from derailed.database import (
     Event,
-    Guild,
-    Invite,
-    Member,
     Track,
     User,
-    get_invite_code,
-    get_member_permissions,
+    get_invite_dict,
+    get_member_snapshot,
     get_new_track_position,
     get_track_dict,
+    get_visible_tracks,
+    insert_invite,
     produce,
     track_has_bit,
 )
@@ -29,87 +30,103 @@ from derailed.exceptions import NoAuthorizationError
 from derailed.identifier import make_snowflake
 from derailed.permissions import RolePermissionEnum, has_bit
 from derailed.rate_limit import track_limit
+from derailed.reads import secondary_reads
 
 router = APIRouter()
 
 
-class CreateTrack(BaseModel):
-    name: str = Field(max_length=55, min_length=1)
-    topic: str | None = Field(max_length=1000, min_length=1)
+class CreateTrack(Body):
+    name: str
+    topic: str | None = None
     parent_id: str | None = None
     type: Literal[0, 1] | None = 1
 
+    def check(self) -> None:
+        check_length('name', self.name, min_length=1, max_length=55)
+        check_length('topic', self.topic, min_length=1, max_length=1000)
+
 
 class CreateInvite(BaseModel):
     expires_at: int | None = None
 
 
-@router.get('/guilds/{guild_id}/tracks')
-@track_limit
+@router.get('/guilds/{guild_id}/tracks', dependencies=[track_limit, secondary_reads])
 async def get_guild_tracks(
     guild_id: str,
     request: Request,
     response: Response,
     user: User | None = Depends(get_user),
-) -> list[dict[str, Any]]:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    if not await Member.find_one(
-        Member.user_id == user.id, Member.guild_id == guild_id
-    ).exists():
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
+
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
-    return [
-        get_track_dict(track=track)
-        async for track in Track.find(Track.guild_id == guild_id)
-    ]
+    tracks = await Track.find(Track.guild_id == guild_id).to_list()
+
+    return respond(
+        [
+            get_track_dict(track=track)
+            for track in get_visible_tracks(
+                snapshot=snapshot, member=member, tracks=tracks
+            )
+        ],
+        request,
+        response,
+    )
 
 
-@router.get('/guilds/{guild_id}/tracks/{track_id}')
-@track_limit
+@router.get(
+    '/guilds/{guild_id}/tracks/{track_id}', dependencies=[track_limit, secondary_reads]
+)
 async def get_guild_track(
     guild_id: str,
     track_id: str,
     request: Request,
     response: Response,
     user: User | None = Depends(get_user),
-) -> dict[str, Any]:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    if not await Member.find_one(
-        Member.user_id == user.id, Member.guild_id == guild_id
-    ).exists():
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
+
+    if member is None:
         raise HTTPException(403, 'You are not a member of this guild')
 
-    return get_track_dict(
-        track=await Track.find_one(Track.guild_id == guild_id, Track.id == track_id)
-    )
+    track = await Track.find_one(Track.guild_id == guild_id, Track.id == track_id)
 
+    if track is None:
+        raise HTTPException(404, 'Track not found')
+
+    if not get_visible_tracks(snapshot=snapshot, member=member, tracks=[track]):
+        raise HTTPException(403, 'Invalid permissions')
 
-@router.post('/guilds/{guild_id}/tracks')
-@track_limit
+    return respond(get_track_dict(track=track), request, response)
+
+
+@router.post('/guilds/{guild_id}/tracks', dependencies=[track_limit])
 async def create_track(
     guild_id: str,
     request: Request,
     response: Response,
-    model: CreateTrack,
+    model: CreateTrack = Depends(read_body(CreateTrack)),
     user: User | None = Depends(get_user),
-) -> dict[str, Any]:
+) -> Response:
     if user is None:
         raise NoAuthorizationError()
 
-    if not await Member.find_one(
-        Member.user_id == user.id, Member.guild_id == guild_id
-    ).exists():
-        raise HTTPException(403, 'You are not a member of this guild')
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
 
-    guild = await Guild.find_one(Guild.id == guild_id)
+    if member is None:
+        raise HTTPException(403, 'You are not a member of this guild')
 
-    is_owner = user.id == guild.owner_id
+    is_owner = snapshot.is_owner(user.id)
 
-    permissions = await get_member_permissions(user_id=user.id, guild_id=guild_id)
+    permissions = snapshot.get_permissions(member)
 
     if not has_bit(permissions, RolePermissionEnum.CREATE_TRACK.value) and not is_owner:
         raise HTTPException(403, 'Invalid permissions')
@@ -145,7 +162,7 @@ async def create_track(
 
     await produce('track', Event('TRACK_CREATE', t, guild_id=guild_id))
 
-    return t
+    return respond(t, request, response)
 
 
 @router.post('/guilds/{guild_id}/tracks/{track_id}/invites')
@@ -160,22 +177,24 @@ async def create_invite(
     if user is None:
         raise NoAuthorizationError()
 
-    track = await Track.find_one(
-        Track.id == track_id, Track.guild_id == guild_id
-    )
+    track = await Track.find_one(Track.id == track_id, Track.guild_id == guild_id)
 
     if not track:
         raise HTTPException(404, 'Track or Guild not found')
 
-    guild = await Guild.find_one(Guild.id == guild_id)
+    snapshot, member = await get_member_snapshot(guild_id=guild_id, user_id=user.id)
+
+    if member is None:
+        raise HTTPException(403, 'You are not a member of this guild')
 
-    is_owner = user.id == guild.owner_id
-    member = await Member.find_one(Member.user_id == user.id, Member.guild_id == guild_id)
+    is_owner = snapshot.is_owner(user.id)
 
-    permissions = await get_member_permissions(user_id=user.id, guild_id=guild_id)
+    permissions = snapshot.get_permissions(member)
 
     if (
-        not track_has_bit(permissions, RolePermissionEnum.CREATE_INVITES.value, track, member)
+        not track_has_bit(
+            permissions, RolePermissionEnum.CREATE_INVITES.value, track, member
+        )
         and not is_owner
     ):
         raise HTTPException(403, 'Invalid permissions')
@@ -187,13 +206,13 @@ async def create_invite(
     ):
         raise HTTPException(400, 'Expiry date is invalid')
 
-    invite = Invite(
-        id=await get_invite_code(),
+    invite = await insert_invite(
         guild_id=guild_id,
         track_id=track_id,
         inviter_id=user.id,
-        expires_at=model.expires_at,
+        expires_at=None
+        if model.expires_at is None
+        else datetime.fromtimestamp(model.expires_at, timezone.utc),
     )
-    await invite.insert()
 
-    return invite.dict()
+    return get_invite_dict(invite)
@@ -3,154 +3,145 @@
 # Copyright 2022 Derailed Inc. All rights reserved.
 #
 # Sharing of any piece of code to any unauthorized third-party is not allowed.
+import asyncio
+from datetime import datetime, timezone
 
-from typing import Any
-
-import pymongo
 from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
-from pydantic import BaseModel, Field
 
+from derailed.codec import Body, check_length, read_body, respond
 from derailed.database import (
     Event,
-    Guild,
     Message,
-    Track,
-    User,
-    Member,
+    TrackContext,
     get_date,
-    get_member_permissions,
     produce,
+    resolve_event_audience,
 )
-from derailed.database.utils import track_has_bit
-from derailed.depends import get_user
-from derailed.exceptions import NoAuthorizationError
-from derailed.identifier import make_snowflake
+from derailed.database.messages import message_store
+from derailed.depends import get_track_context
+from derailed.identifier import make_snowflake, snowflake_bound
 from derailed.permissions import RolePermissionEnum
 from derailed.rate_limit import track_limit
+from derailed.reads import secondary_reads
 
 router = APIRouter()
 
+SNOWFLAKE = r'^[0-9]{1,19}$'
+MAX_SNOWFLAKE = (1 << 63) - 1
+
+
+class MessageAction(Body):
+    content: str
+
+    def check(self) -> None:
+        check_length('content', self.content, min_length=1, max_length=1000)
 
-class MessageAction(BaseModel):
-    content: str = Field(min_length=1, max_length=1000)
 
+def to_unix_ms(time: datetime) -> int:
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
 
-@router.get('/tracks/{track_id}/messages')
-@track_limit
+    return int(time.timestamp() * 1000)
+
+
+@router.get('/tracks/{track_id}/messages', dependencies=[track_limit, secondary_reads])
 async def get_track_messages(
     track_id: str,
     request: Request,
     response: Response,
     limit: int = Query(50, gt=0, lt=200),
-    user: User | None = Depends(get_user),
-) -> dict[str, Any]:
-    if user is None:
-        raise NoAuthorizationError()
-
-    track = await Track.find_one(Track.id == track_id)
+    before: str | None = Query(None, regex=SNOWFLAKE),
+    after: str | None = Query(None, regex=SNOWFLAKE),
+    around: str | None = Query(None, regex=SNOWFLAKE),
+    since: datetime | None = Query(None),
+    until: datetime | None = Query(None),
+    context: TrackContext = Depends(get_track_context),
+) -> Response:
+    if not context.has(RolePermissionEnum.VIEW_MESSAGE_HISTORY.value):
+        raise HTTPException(403, 'Invalid permissions')
 
-    if not track:
-        raise HTTPException(404, 'Track not found')
+    if sum(cursor is not None for cursor in (before, after, around)) > 1:
+        raise HTTPException(400, 'Only one of before, after or around can be used')
 
-    permissions = await get_member_permissions(user_id=user.id, guild_id=track.guild_id)
+    lower, upper = -1, MAX_SNOWFLAKE
 
-    guild = await Guild.find_one(Guild.id == track.guild_id)
+    # times are turned into the snowflakes bounding them
+    if since is not None:
+        lower = int(snowflake_bound(to_unix_ms(since))) - 1
 
-    is_owner = user.id == guild.owner_id
-    member = await Member.find_one(Member.user_id == user.id, Member.guild_id == guild.id)
+    if until is not None:
+        upper = int(snowflake_bound(to_unix_ms(until), upper=True)) + 1
 
-    if (
-        not track_has_bit(permissions, RolePermissionEnum.VIEW_MESSAGE_HISTORY.value, track, member)
-        and not is_owner
-    ):
-        raise HTTPException(403, 'Invalid permissions')
+    if after is not None:
+        lower = max(lower, int(after))
 
-    messages = []
+    if before is not None:
+        upper = min(upper, int(before))
 
-    async for message in Message.find(
-        Message.track_id == track_id,
-        limit=limit,
-        sort=[(Message.id, pymongo.DESCENDING)],
-    ):
-        messages.append(message.dict())
+    if around is not None:
+        older, newer = await asyncio.gather(
+            message_store.history(
+                track_id, limit=limit // 2, after=lower, before=min(upper, int(around))
+            ),
+            message_store.history(
+                track_id,
+                limit=limit - limit // 2,
+                after=max(lower, int(around) - 1),
+                before=upper,
+                oldest_first=True,
+            ),
+        )
+        messages = newer[::-1] + older
+    elif after is not None:
+        # the page closest to the cursor, still returned newest first
+        messages = await message_store.history(
+            track_id, limit=limit, after=lower, before=upper, oldest_first=True
+        )
+        messages.reverse()
+    else:
+        messages = await message_store.history(
+            track_id, limit=limit, after=lower, before=upper
+        )
 
-    return messages
+    return respond(messages, request, response)
 
 
-@router.get('/tracks/{track_id}/messages/{message_id}')
-@track_limit
+@router.get(
+    '/tracks/{track_id}/messages/{message_id}',
+    dependencies=[track_limit, secondary_reads],
+)
 async def get_track_message(
     track_id: str,
     message_id: str,
     request: Request,
     response: Response,
-    user: User | None = Depends(get_user),
-) -> dict[str, Any]:
-    if user is None:
-        raise NoAuthorizationError()
-
-    track = await Track.find_one(Track.id == track_id)
-
-    if not track:
-        raise HTTPException(404, 'Track not found')
-
-    permissions = await get_member_permissions(user_id=user.id, guild_id=track.guild_id)
-
-    guild = await Guild.find_one(Guild.id == track.guild_id)
-
-    is_owner = user.id == guild.owner_id
-    member = await Member.find_one(Member.user_id == user.id, Member.guild_id == guild.id)
-
-    if (
-        not track_has_bit(permissions, RolePermissionEnum.VIEW_MESSAGE_HISTORY.value, track, member)
-        and not is_owner
-    ):
+    context: TrackContext = Depends(get_track_context),
+) -> Response:
+    if not context.has(RolePermissionEnum.VIEW_MESSAGE_HISTORY.value):
         raise HTTPException(403, 'Invalid permissions')
 
-    message = await Message.find_one(Message.id == message_id)
+    message = await message_store.get(track_id=track_id, message_id=message_id)
 
     if message is None:
         raise HTTPException(404, 'Message not found')
 
-    return message.dict()
+    return respond(message.dict(), request, response)
 
 
-@router.post('/tracks/{track_id}/messages')
-@track_limit
+@router.post('/tracks/{track_id}/messages', dependencies=[track_limit])
 async def create_message(
     track_id: str,
     request: Request,
     response: Response,
-    model: MessageAction,
-    user: User | None = Depends(get_user),
-) -> dict[str, Any]:
-    if user is None:
-        raise NoAuthorizationError()
-
-    track = await Track.find_one(Track.id == track_id)
-
-    if not track:
-        raise HTTPException(404, 'Track not found')
-
-    if track.guild_id:
-        permissions = await get_member_permissions(
-            user_id=user.id, guild_id=track.guild_id
-        )
-
-        guild = await Guild.find_one(Guild.id == track.guild_id)
-
-        is_owner = user.id == guild.owner_id
-        member = await Member.find_one(Member.user_id == user.id, Member.guild_id == guild.id)
-
-        if (
-            not track_has_bit(permissions, RolePermissionEnum.CREATE_MESSAGE.value, track, member)
-            and not is_owner
-        ):
-            raise HTTPException(403, 'Invalid permissions')
+    model: MessageAction = Depends(read_body(MessageAction)),
+    context: TrackContext = Depends(get_track_context),
+) -> Response:
+    if not context.has(RolePermissionEnum.CREATE_MESSAGE.value):
+        raise HTTPException(403, 'Invalid permissions')
 
     message = Message(
         id=make_snowflake(),
-        author_id=user.id,
+        author_id=context.user.id,
         track_id=track_id,
         timestamp=get_date(),
         edited_timestamp=None,
@@ -158,88 +149,77 @@ async def create_message(
         type=0,
         content=model.content.strip(),
     )
-    await message.insert()
+    await message_store.insert(message)
 
     m = message.dict()
 
-    await produce('messages', Event('MESSAGE_CREATE', m, guild_id=guild.id))
+    await produce(
+        'messages',
+        Event(
+            'MESSAGE_CREATE',
+            m,
+            guild_id=context.track.guild_id,
+            audience=await resolve_event_audience(context.track),
+        ),
+    )
 
-    return m
+    return respond(m, request, response)
 
 
-@router.patch('/tracks/{track_id}/messages/{message_id}')
-@track_limit
+@router.patch('/tracks/{track_id}/messages/{message_id}', dependencies=[track_limit])
 async def modify_message(
     track_id: str,
     message_id: str,
     request: Request,
     response: Response,
-    model: MessageAction,
-    user: User | None = Depends(get_user),
-) -> dict[str, Any]:
-    if user is None:
-        raise NoAuthorizationError()
-
-    track = await Track.find_one(Track.id == track_id)
-
-    if not track:
-        raise HTTPException(404, 'Track not found')
+    model: MessageAction = Depends(read_body(MessageAction)),
+    context: TrackContext = Depends(get_track_context),
+) -> Response:
+    message = await message_store.get(track_id=track_id, message_id=message_id)
 
-    message = await Message.find_one(
-        Message.track_id == track_id, Message.id == message_id
-    )
+    if message is None:
+        raise HTTPException(404, 'Message not found')
 
-    if message.author_id != user.id:
+    if message.author_id != context.user.id:
         raise HTTPException(403, 'You are not the creator of this message')
 
-    await message.update(content=model.content.strip())
+    await message_store.edit(message, content=model.content.strip())
 
     m = message.dict()
 
-    await produce('messages', Event('MESSAGE_MODIFY', m, guild_id=track.guild_id))
+    await produce(
+        'messages',
+        Event(
+            'MESSAGE_MODIFY',
+            m,
+            guild_id=context.track.guild_id,
+            audience=await resolve_event_audience(context.track),
+        ),
+    )
 
-    return m
+    return respond(m, request, response)
 
 
-@router.delete('/tracks/{track_id}/messages/{message_id}')
-@track_limit
+@router.delete('/tracks/{track_id}/messages/{message_id}', dependencies=[track_limit])
 async def delete_message(
     track_id: str,
     message_id: str,
     request: Request,
     response: Response,
-    user: User | None = Depends(get_user),
+    context: TrackContext = Depends(get_track_context),
 ) -> str:
-    if user is None:
-        raise NoAuthorizationError()
-
-    track = await Track.find_one(Track.id == track_id)
-
-    if not track:
-        raise HTTPException(404, 'Track not found')
+    message = await message_store.get(track_id=track_id, message_id=message_id)
 
-    if track.guild_id:
-        permissions = await get_member_permissions(
-            user_id=user.id, guild_id=track.guild_id
-        )
-
-        guild = await Guild.find_one(Guild.id == track.guild_id)
-
-        is_owner = user.id == guild.owner_id
-        member = await Member.find_one(Member.user_id == user.id, Member.guild_id == guild.id)
-
-    message = await Message.find_one(
-        Message.track_id == track_id, Message.id == message_id
-    )
+    if message is None:
+        raise HTTPException(404, 'Message not found')
 
     if (
-        not track_has_bit(permissions, RolePermissionEnum.DELETE_MESSAGES.value, track, member)
-        and not is_owner
-        and message.author_id != user.id
+        not context.has(RolePermissionEnum.DELETE_MESSAGES.value)
+        and message.author_id != context.user.id
     ):
         raise HTTPException(403, 'Invalid permissions')
 
-    await message.delete()
+    await message_store.delete(message)
 
     await produce(
         'messages',
@@ -248,9 +228,10 @@ async def delete_message(
             {
                 'message_id': message.id,
                 'track_id': message.track_id,
-                'guild_id': guild.id,
+                'guild_id': context.track.guild_id,
             },
-            guild_id=guild.id,
+            guild_id=context.track.guild_id,
+            audience=await resolve_event_audience(context.track),
         ),
     )
 
@@ -7,79 +7,55 @@ import itertools
 from typing import Any, Literal
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
-from pydantic import BaseModel, Field
 
+from derailed.codec import Body, check_length, read_body, respond
 from derailed.database import (
-    Guild,
     Member,
-    Message,
     Overwrite,
     Pin,
     Role,
-    Track,
-    User,
-    get_member_permissions,
+    TrackContext,
     get_track_dict,
     produce,
-    track_has_bit,
 )
 from derailed.database.event import Event
-from derailed.depends import get_user
-from derailed.exceptions import NoAuthorizationError
-from derailed.permissions import RolePermissionEnum, has_bit
+from derailed.database.messages import message_store
+from derailed.depends import get_track_context
+from derailed.permissions import RolePermissionEnum
 from derailed.rate_limit import track_limit
 
 router = APIRouter()
 
 
-class AddOverwrite(BaseModel):
+class AddOverwrite(Body):
     object_id: str
     type: Literal[0, 1]
     allow: int
     deny: int
 
 
-class ModifyTrack(BaseModel):
-    name: str | None | bool = Field(default=False)
-    topic: str | None = Field(None, max_length=1000, min_length=1)
-    add_overwrites: list[AddOverwrite] | None = Field(None)
-    remove_overwrites: list[str] | None = Field(None)
+class ModifyTrack(Body):
+    name: str | None | bool = False
+    topic: str | None = None
+    add_overwrites: list[AddOverwrite] | None = None
+    remove_overwrites: list[str] | None = None
 
+    def check(self) -> None:
+        check_length('topic', self.topic, min_length=1, max_length=1000)
 
-@router.patch('/tracks/{track_id}')
-@track_limit
+
+@router.patch('/tracks/{track_id}', dependencies=[track_limit])
 async def modify_track(
     track_id: str,
-    model: ModifyTrack,
     request: Request,
     response: Response,
-    user: User | None = Depends(get_user),
-) -> dict:
-    if user is None:
-        raise NoAuthorizationError()
-
-    track = await Track.find_one(Track.id == track_id)
-
-    if track is None:
-        raise HTTPException(404, 'Track not found')
+    model: ModifyTrack = Depends(read_body(ModifyTrack)),
+    context: TrackContext = Depends(get_track_context),
+) -> Response:
+    track = context.track
 
-    if track.guild_id:
-        permissions = await get_member_permissions(
-            user_id=user.id, guild_id=track.guild_id
-        )
-
-        guild = await Guild.find_one(Guild.id == track.guild_id)
-
-        is_owner = user.id == guild.owner_id
-        member = await Member.find_one(Member.user_id == user.id, Member.guild_id == track.guild_id)
-
-        if (
-            not track_has_bit(permissions, RolePermissionEnum.MODIFY_TRACK.value, track, member)
-            and not is_owner
-        ):
-            raise HTTPException(403, 'Invalid permissions')
-    elif user.id not in track.members:
-        raise HTTPException(403, 'You are not a member of this track')
+    if not context.has(RolePermissionEnum.MODIFY_TRACK.value):
+        raise HTTPException(403, 'Invalid permissions')
 
     updates: dict[str, Any] = {}
 
@@ -150,7 +126,8 @@ async def modify_track(
                 )
             )
 
-    await track.update(updates)
+    if updates:
+        await track.set(updates)
 
     track_data = get_track_dict(track=track)
 
@@ -160,39 +137,21 @@ async def modify_track(
             Event('TRACK_MODIFY', track_data, guild_id=track.guild_id),
         )
 
-    return track_data
+    return respond(track_data, request, response)
 
 
-@router.delete('/tracks/{track_id}', status_code=204)
-@track_limit
+@router.delete('/tracks/{track_id}', status_code=204, dependencies=[track_limit])
 async def delete_track(
     track_id: str,
     request: Request,
     response: Response,
-    user: User | None = Depends(get_user),
+    context: TrackContext = Depends(get_track_context),
 ) -> str:
-    if user is None:
-        raise NoAuthorizationError()
+    track = context.track
+    user = context.user
 
-    track = await Track.find_one(Track.id == track_id)
-
-    if track is None:
-        raise HTTPException(404, 'Track not found')
-
-    if track.guild_id:
-        permissions = await get_member_permissions(
-            user_id=user.id, guild_id=track.guild_id
-        )
-
-        guild = await Guild.find_one(Guild.id == track.guild_id)
-
-        is_owner = user.id == guild.owner_id
-
-        if (
-            not has_bit(permissions, RolePermissionEnum.DELETE_TRACKS.value)
-            and not is_owner
-        ):
-            raise HTTPException(403, 'Invalid permissions')
+    if track.guild_id and not context.has(RolePermissionEnum.DELETE_TRACKS.value):
+        raise HTTPException(403, 'Invalid permissions')
 
     if track.type in (2, 3):
         track.members.remove(user.id)
@@ -200,20 +159,18 @@ async def delete_track(
         if track.members == []:
             await track.delete()
 
-            messages = Message.find(Message.track_id == track.id)
             pins = Pin.find(Pin.origin == track.id)
 
-            await messages.delete()
+            await message_store.delete_track(track.id)
             await pins.delete()
         else:
             await track.update()
     else:
         await track.delete()
 
-        messages = Message.find(Message.track_id == track.id)
         pins = Pin.find(Pin.origin == track.id)
 
-        await messages.delete()
+        await message_store.delete_track(track.id)
         await pins.delete()
 
     await produce(
@@ -221,7 +178,7 @@ async def delete_track(
         Event(
             'TRACK_DELETE',
             {'track_id': track.id, 'guild_id': track.guild_id},
-            guild_id=guild.id if track.guild_id else None,
+            guild_id=track.guild_id,
             user_id=user.id if track.type in (2, 3) else None,
         ),
     )
@@ -6,8 +6,6 @@
 from random import randint
 from typing import Any
 
-from argon2 import PasswordHasher
-from argon2.exceptions import VerificationError
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from pydantic import BaseModel, EmailStr, Field
 
@@ -21,13 +19,15 @@ from derailed.database import (
     User,
     create_token,
     produce,
+    revoke_tokens,
+    writes,
 )
 from derailed.depends import get_user
 from derailed.exceptions import NoAuthorizationError
 from derailed.identifier import make_snowflake
+from derailed.passwords import hash_password, verify_password
 from derailed.rate_limit import rate_limiter
-
-ph = PasswordHasher()
+from derailed.reads import secondary_reads
 
 router = APIRouter(tags=['User'])
 
@@ -79,8 +79,9 @@ async def find_discriminator(username: str) -> str:
 FORBIDDEN_USERNAMES = {'derailed'}
 
 
-@router.post('/register', status_code=201)
-@rate_limiter.limit('1/minute')
+@router.post(
+    '/register', status_code=201, dependencies=[rate_limiter.limit('1/minute')]
+)
 async def register(model: Register, request: Request, response: Response) -> dict:
     if model.username.lower() in FORBIDDEN_USERNAMES:
         raise HTTPException(403, 'Forbidden username')
@@ -99,19 +100,23 @@ async def register(model: Register, request: Request, response: Response) -> dic
         id=user_id,
         email=model.email,
         username=model.username,
-        password=ph.hash(model.password),
+        password=await hash_password(model.password),
         discriminator=await find_discriminator(username=model.username),
     )
     settings = Settings(id=user_id)
     presence = Presence(id=user.id, status='offline', content=None, timestamp=None)
     profile = Profile(id=user.id, bio=None)
-    await user.insert()
-    await settings.insert()
-    await presence.insert()
-    await profile.insert()
+    # the rest of a new account is written as durably as the user itself
+    with writes('strong'):
+        await user.insert()
+        await settings.insert()
+        await presence.insert()
+        await profile.insert()
 
     formatted_user = user.dict(exclude={'password'})
-    formatted_user['token'] = create_token(user_id=user_id, user_password=user.password)
+    formatted_user['token'] = await create_token(
+        user_id=user_id, user_password=user.password
+    )
     return formatted_user
 
 
@@ -122,12 +127,10 @@ async def login(model: Login, request: Request, response: Response) -> dict:
     if user is None:
         raise HTTPException(400, 'Invalid email entered')
 
-    try:
-        ph.verify(user.password, model.password)
-    except VerificationError:
+    if not await verify_password(user.password, model.password):
         raise HTTPException(403, 'Incorrect password entered')
 
-    return {'token': create_token(user_id=user.id, user_password=user.password)}
+    return {'token': await create_token(user_id=user.id, user_password=user.password)}
 
 
 @router.get('/users/@me', status_code=200)
@@ -140,7 +143,7 @@ async def get_current_user(
     return user.dict(exclude={'password'})
 
 
-@router.get('/users/{user_id}', status_code=200)
+@router.get('/users/{user_id}', status_code=200, dependencies=[secondary_reads])
 async def get_user(
     user_id: str,
     request: Request,
@@ -185,8 +188,9 @@ async def patch_current_user(
             user.discriminator = await find_discriminator(model.username)
 
     if model.password:
-        user.password = ph.hash(model.password)
+        user.password = await hash_password(model.password)
 
+        await revoke_tokens(user_id=user.id)
         await produce('security', Event('USER_DISCONNECT', {}, user_id=user.id))
 
     await user.save()
@@ -209,9 +213,7 @@ async def delete_current_user(
     if user is None:
         raise NoAuthorizationError()
 
-    try:
-        ph.verify(user.password, model.password)
-    except VerificationError:
+    if not await verify_password(user.password, model.password):
         raise HTTPException(403, 'Incorrect password entered')
 
     guilds = Member.find(Member.user_id == user.id)
@@ -233,6 +235,7 @@ async def delete_current_user(
 
     settings = await User.find_one(Settings.user_id == user.id)
 
+    await revoke_tokens(user_id=user.id)
     await produce('security', Event('USER_DISCONNECT', {}, user_id=user.id))
 
     user.delete()
@@ -29,7 +29,7 @@ async def put_presence(
 
     presence = await Presence.find_one(Presence.id == user.id)
 
-    await presence.update(content=model.content)
+    await presence.set({Presence.content: model.content})
 
     await produce(
         'presences', Event('PRESENCE_UPDATE', presence.dict(), user_id=user.id)
@@ -1,3 +1,6 @@
 #!/bin/sh
 
+# indexes and data migrations are applied once here, not by every worker
+python -m derailed.database.migrate || exit 1
+
 exec gunicorn -w $((`nproc` * 2 + 1)) -k "uvicorn.workers.UvicornWorker" -b "0.0.0.0:5000" "app:app"